@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Micro-benchmark of the helpers run for every part and every upload:
+bytes_to_hex, check_description and chunk_hashes, against the
+implementations they replaced.
+
+    $ python benchmarks/bench_helpers.py
+    $ python benchmarks/bench_helpers.py --repeat 5 --part-size 64
+
+Times are per call, the best of --repeat runs.
+"""
+
+import os
+import sys
+import math
+import time
+import hashlib
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "glacier"))
+import glaciercorecalls
+import glacier
+
+def legacy_bytes_to_hex(str):
+    return ''.join( [ "%02x" % ord( x ) for x in str] ).strip()
+
+def legacy_check_description(description):
+    if len(description) > 1024:
+        raise Exception(u"Description must be less or equal to 1024 characters.")
+
+    for char in description:
+        n = ord(char)
+        if n < 32 or n > 126:
+            raise Exception(u"The allowable characters are 7-bit ASCII without \
+                              control codes, specifically ASCII values 32—126 \
+                              decimal or 0x20—0x7E hexadecimal.")
+    return True
+
+def legacy_chunk_hashes(data):
+    chunk = 1024*1024
+    chunk_count = int(math.ceil(len(data)/float(chunk)))
+    chunks = (data[i*chunk:(i+1)*chunk] for i in xrange(chunk_count))
+    return [glaciercorecalls.sha256_digest(x) for x in chunks]
+
+def per_call(func, arg, calls, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        for j in xrange(calls):
+            result = func(arg)
+        elapsed = (time.time() - start) / calls
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description="per-part helper micro-benchmark")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--part-size', type=int, default=16,
+                        help="Size in MB of the part given to chunk_hashes.")
+    args = parser.parse_args()
+
+    digest = hashlib.sha256("glacier").digest()
+    part = os.urandom(args.part_size * 1024 * 1024)
+    cases = [
+        ("bytes_to_hex (32 bytes)", legacy_bytes_to_hex,
+         glaciercorecalls.bytes_to_hex, digest, 100000),
+        ("check_description (60)", legacy_check_description,
+         glacier.check_description, "/home/user/photos/2012/holiday/IMG_0001.jpg" + "x" * 17, 100000),
+        ("check_description (1024)", legacy_check_description,
+         glacier.check_description, "d" * 1024, 10000),
+        ("chunk_hashes (%d MB)" % (args.part_size,), legacy_chunk_hashes,
+         glaciercorecalls.chunk_hashes, part, 3),
+    ]
+
+    print "%-26s %14s %14s %10s" % ("helper", "legacy (us)", "current (us)", "speedup")
+    for name, legacy, current, arg, calls in cases:
+        old_time, old_result = per_call(legacy, arg, calls, args.repeat)
+        new_time, new_result = per_call(current, arg, calls, args.repeat)
+        assert old_result == new_result, "%s results differ" % (name,)
+        print "%-26s %14.2f %14.2f %9.1fx" % (name, old_time * 1e6, new_time * 1e6,
+                                              old_time / new_time)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+End to end upload and download benchmark of glacier-cmd against the
+fake Glacier server in benchmarks/fakeglacier.py, no AWS account needed.
+
+    $ python benchmarks/bench_transfer.py
+    $ python benchmarks/bench_transfer.py --sizes 64 256 --part-sizes 1 8 32 \\
+          --concurrency 1 4 --latency 0.05 --bandwidth 20 --error-rate 0.01
+
+Every case runs the glacier-cmd CLI in a process of its own, so the
+timings include start-up and the peak RSS is that of the one transfer.
+Requests are counted by the server; retried requests count every try.
+With --json the results are also written to a file, to compare runs.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import urllib2
+import argparse
+import tempfile
+import subprocess
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+GLACIER_CMD = os.path.join(BENCHMARKS, "..", "glacier", "glacier.py")
+FAKE_GLACIER = os.path.join(BENCHMARKS, "fakeglacier.py")
+MB = 1024*1024
+VAULT = "Benchmark"
+
+def start_server(args, directory):
+    command = [sys.executable, FAKE_GLACIER, '--port', '0',
+               '--latency', str(args.latency), '--error-rate', str(args.error_rate),
+               '--directory', directory]
+    if args.bandwidth:
+        command += ['--bandwidth', str(args.bandwidth)]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE)
+    url = server.stdout.readline().split()[-1]
+    return server, url
+
+def server_stats(url):
+    return json.load(urllib2.urlopen(url + "/_stats"))
+
+def make_file(path, size):
+    with open(path, "wb") as fo:
+        for offset in xrange(0, size, MB):
+            fo.write(os.urandom(min(MB, size - offset)))
+
+class Runner(object):
+    """
+    Runs glacier-cmd subcommands against the fake server and measures them.
+    """
+    def __init__(self, url, directory):
+        self.url = url
+        self.directory = directory
+        self.env = dict(os.environ, HOME=directory)
+
+    def run(self, *arguments):
+        command = [sys.executable, GLACIER_CMD,
+                   '--aws-access-key', 'benchmark', '--aws-secret-key', 'benchmark',
+                   '--region', 'us-east-1', '--endpoint', self.url,
+                   '--catalog', os.path.join(self.directory, "catalog.db")] + list(arguments)
+        before = server_stats(self.url)
+        with tempfile.TemporaryFile() as output:
+            start = time.time()
+            process = subprocess.Popen(command, stdout=output, stderr=subprocess.STDOUT,
+                                       cwd=self.directory, env=self.env)
+            pid, status, usage = os.wait4(process.pid, 0)
+            elapsed = time.time() - start
+            output.seek(0)
+            text = output.read()
+        if status:
+            raise Exception("%s failed:\n%s" % (" ".join(arguments), text))
+        after = server_stats(self.url)
+        requests = sum(after.values()) - sum(before.values())
+        errors = after.get("injected_errors", 0) - before.get("injected_errors", 0)
+        # ru_maxrss is in kilobytes on Linux.
+        return text, elapsed, usage.ru_maxrss / 1024.0, requests - errors, errors
+
+def report(results, op, size, part_size, concurrency, measured):
+    text, elapsed, rss, requests, errors = measured
+    result = {"op": op, "size_mb": size, "part_size_mb": part_size,
+              "concurrency": concurrency, "seconds": elapsed,
+              "mb_per_second": size / elapsed, "peak_rss_mb": rss,
+              "requests": requests, "injected_errors": errors}
+    results.append(result)
+    print "%-9s %8d %8s %5d %9.2f %9.1f %9.1f %9d %7d" % (
+        op, size, part_size or "-", concurrency, elapsed, size / elapsed, rss,
+        requests, errors)
+    sys.stdout.flush()
+
+def main():
+    parser = argparse.ArgumentParser(description="glacier-cmd transfer benchmark")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[16, 64],
+                        help="Archive sizes in MB.")
+    parser.add_argument('--part-sizes', type=int, nargs='+', default=[1, 4, 16],
+                        help="Upload part sizes in MB.")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4],
+                        help="Numbers of parallel uploads and downloads.")
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help="Seconds the server waits before each request.")
+    parser.add_argument('--bandwidth', type=float, default=None,
+                        help="Server MB/s per connection, unlimited by default.")
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help="Fraction of requests the server fails.")
+    parser.add_argument('--json', metavar='FILE',
+                        help="Also write the results to FILE.")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="bench-transfer-")
+    server, url = start_server(args, os.path.join(directory, "server"))
+    try:
+        runner = Runner(url, directory)
+        runner.run('mkvault', VAULT)
+        results = []
+        print "%-9s %8s %8s %5s %9s %9s %9s %9s %7s" % (
+            "op", "size MB", "part MB", "conc", "seconds", "MB/s", "RSS MB",
+            "requests", "errors")
+        for size in args.sizes:
+            filename = os.path.join(directory, "archive-%d" % (size,))
+            make_file(filename, size * MB)
+            archive_id = None
+            for part_size in args.part_sizes:
+                for concurrency in args.concurrency:
+                    measured = runner.run('upload', '--partsize', str(part_size),
+                                          '--concurrency', str(concurrency),
+                                          VAULT, filename)
+                    archive_id = re.search(r"Created archive with ID:\s+(\S+)",
+                                           measured[0]).group(1)
+                    report(results, "upload", size, part_size, concurrency, measured)
+
+            # Start the retrieval job, the fake completes it right away.
+            runner.run('getarchive', VAULT, archive_id)
+            out_file = os.path.join(directory, "download")
+            for concurrency in args.concurrency:
+                measured = runner.run('getarchive', '--concurrency', str(concurrency),
+                                      VAULT, archive_id, out_file)
+                if os.path.getsize(out_file) != size * MB:
+                    raise Exception("Downloaded %d bytes of %d"
+                                    % (os.path.getsize(out_file), size * MB))
+                os.remove(out_file)
+                report(results, "download", size, None, concurrency, measured)
+            os.remove(filename)
+
+        if args.json:
+            with open(args.json, "w") as fo:
+                json.dump({"latency": args.latency, "bandwidth": args.bandwidth,
+                           "error_rate": args.error_rate, "results": results},
+                          fo, indent=2)
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Micro-benchmark of glaciercorecalls.tree_hash against the original
+pop(0) based implementation.
+
+    $ python benchmarks/bench_treehash.py
+    $ python benchmarks/bench_treehash.py --leaves 10000 1000000 --legacy-max 1000000
+
+The original implementation is quadratic, so by default it is only
+timed up to --legacy-max leaves.
+"""
+
+import os
+import sys
+import time
+import hashlib
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "glacier"))
+import glaciercorecalls
+
+def legacy_tree_hash(fo):
+    """
+    The tree_hash implementation this benchmark compares against.
+    """
+    hashes = []
+    hashes.extend(fo)
+    while len(hashes) > 1:
+        new_hashes = []
+        while True:
+            if len(hashes) > 1:
+                first = hashes.pop(0)
+                second = hashes.pop(0)
+                new_hashes.append(hashlib.sha256(first + second).digest())
+            elif len(hashes) == 1:
+                only = hashes.pop(0)
+                new_hashes.append(only)
+            else:
+                break
+        hashes.extend(new_hashes)
+    return hashes[0]
+
+def best_of(func, leaves, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = func(leaves)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description="tree_hash micro-benchmark")
+    parser.add_argument('--leaves', type=int, nargs='+', default=[10000, 1000000],
+                        help="Numbers of leaf hashes to benchmark with.")
+    parser.add_argument('--legacy-max', type=int, default=100000,
+                        help="Largest leaf count to time the old implementation at.")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print "%10s %14s %14s %10s" % ("leaves", "legacy (s)", "tree_hash (s)", "speedup")
+    for count in args.leaves:
+        leaves = [hashlib.sha256(str(i)).digest() for i in xrange(count)]
+        new_time, new_hash = best_of(glaciercorecalls.tree_hash, leaves, args.repeat)
+        if count <= args.legacy_max:
+            old_time, old_hash = best_of(legacy_tree_hash, leaves, args.repeat)
+            assert old_hash == new_hash, "tree hashes differ for %d leaves" % (count,)
+            print "%10d %14.4f %14.4f %9.1fx" % (count, old_time, new_time,
+                                                 old_time / new_time)
+        else:
+            print "%10d %14s %14.4f %10s" % (count, "skipped", new_time, "-")
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,632 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+A stand-in for the Amazon Glacier API on localhost, for trying out and
+benchmarking glacier-cmd without an AWS account.
+
+    $ python benchmarks/fakeglacier.py --port 8080 --latency 0.05 --bandwidth 10
+    $ glacier-cmd --endpoint http://localhost:8080 lsvault
+
+It implements vaults, multipart and single request uploads, archive and
+inventory retrieval jobs (which complete --job-delay seconds after they
+are started), ranged job output with tree hashes, and the list calls
+with their markers. Requests are not authenticated and any vault name
+is created on first use. Archives are kept in a temporary directory.
+
+Every request is delayed by --latency seconds, request and response
+bodies move at --bandwidth MB/s per connection and a --error-rate
+fraction of the requests fail with a 500 or a throttling error.
+
+GET /_stats returns the number of requests handled per operation.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import urllib
+import urlparse
+import argparse
+import binascii
+import tempfile
+import threading
+import collections
+import SocketServer
+import BaseHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "glacier"))
+import glaciercorecalls
+
+MB = 1024*1024
+BLOCK_SIZE = 64*1024
+ACCOUNT_ARN = "arn:aws:glacier:local:000000000000:vaults/"
+
+def iso_date(timestamp):
+    return time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(timestamp))
+
+def new_id():
+    return binascii.hexlify(os.urandom(24))
+
+class GlacierFault(Exception):
+    """
+    Error answered to the client as Glacier's JSON error document.
+    """
+    def __init__(self, status, code, message):
+        Exception.__init__(self, message)
+        self.status = status
+        self.code = code
+        self.message = message
+
+class FakeGlacier(object):
+    """
+    State of the fake service: vaults with their archives, multipart
+    uploads and jobs. Archive data lives in files under `directory`,
+    only the megabyte chunk hashes of every archive are kept in memory.
+    """
+    def __init__(self, directory, job_delay=0):
+        self.directory = directory
+        self.job_delay = job_delay
+        self.lock = threading.RLock()
+        self.vaults = {}
+        self.requests = collections.defaultdict(int)
+
+    def count(self, operation):
+        with self.lock:
+            self.requests[operation] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.requests)
+
+    def vault(self, name, create=True):
+        with self.lock:
+            if name not in self.vaults:
+                if not create:
+                    raise GlacierFault(404, "ResourceNotFoundException",
+                                       "Vault not found: %s" % (name,))
+                self.vaults[name] = {'name': name, 'created': time.time(),
+                                     'archives': {}, 'uploads': {}, 'jobs': {},
+                                     'inventory_date': None}
+            return self.vaults[name]
+
+    def find(self, vault, kind, item_id):
+        with self.lock:
+            if item_id not in vault[kind]:
+                raise GlacierFault(404, "ResourceNotFoundException",
+                                   "No %s with id %s" % (kind[:-1], item_id))
+            return vault[kind][item_id]
+
+    def path(self, item_id):
+        return os.path.join(self.directory, item_id)
+
+    def describe_vault(self, vault):
+        archives = vault['archives'].values()
+        return {"CreationDate": iso_date(vault['created']),
+                "LastInventoryDate": vault['inventory_date'] and iso_date(vault['inventory_date']),
+                "NumberOfArchives": len(archives),
+                "SizeInBytes": sum(archive['size'] for archive in archives),
+                "VaultARN": ACCOUNT_ARN + vault['name'],
+                "VaultName": vault['name']}
+
+    def add_archive(self, vault, path, description, chunks, expected_hash):
+        tree_hash = glaciercorecalls.bytes_to_hex(glaciercorecalls.tree_hash(chunks))
+        if expected_hash != tree_hash:
+            raise GlacierFault(400, "InvalidParameterValueException",
+                               "Tree hash %s does not match the data (%s)"
+                               % (expected_hash, tree_hash))
+        archive_id = new_id()
+        os.rename(path, self.path(archive_id))
+        archive = {'id': archive_id, 'description': description,
+                   'size': os.path.getsize(self.path(archive_id)),
+                   'created': time.time(), 'chunks': chunks, 'tree_hash': tree_hash}
+        with self.lock:
+            vault['archives'][archive_id] = archive
+        return archive
+
+    def inventory(self, vault):
+        now = time.time()
+        with self.lock:
+            vault['inventory_date'] = now
+            archives = sorted(vault['archives'].values(), key=lambda a: a['created'])
+        return json.dumps({
+            "VaultARN": ACCOUNT_ARN + vault['name'],
+            "InventoryDate": iso_date(now),
+            "ArchiveList": [{"ArchiveId": archive['id'],
+                             "ArchiveDescription": archive['description'],
+                             "CreationDate": iso_date(archive['created']),
+                             "Size": archive['size'],
+                             "SHA256TreeHash": archive['tree_hash']}
+                            for archive in archives]})
+
+    def describe_job(self, vault, job):
+        completed = time.time() >= job['completes']
+        description = {
+            "Action": job['action'],
+            "ArchiveId": None, "ArchiveSizeInBytes": None,
+            "ArchiveSHA256TreeHash": None, "InventorySizeInBytes": None,
+            "Completed": completed,
+            "CompletionDate": iso_date(job['completes']) if completed else None,
+            "CreationDate": iso_date(job['created']),
+            "JobDescription": job['description'],
+            "JobId": job['id'],
+            "SHA256TreeHash": None,
+            "SNSTopic": job['sns_topic'],
+            "StatusCode": "Succeeded" if completed else "InProgress",
+            "StatusMessage": "Succeeded" if completed else None,
+            "VaultARN": ACCOUNT_ARN + vault['name']}
+        if job['archive']:
+            archive = job['archive']
+            description.update({"ArchiveId": archive['id'],
+                                "ArchiveSizeInBytes": archive['size'],
+                                "ArchiveSHA256TreeHash": archive['tree_hash'],
+                                "SHA256TreeHash": archive['tree_hash'],
+                                "RetrievalByteRange": "0-%d" % (archive['size'] - 1,)})
+        else:
+            description["InventorySizeInBytes"] = len(job['inventory'])
+        return description
+
+def page(items, query, key):
+    """
+    The page of items requested by the limit and marker query parameters,
+    and the marker of the next page (or None). The marker is the key of
+    the last item of the previous page.
+    """
+    limit = int(query.get('limit', 1000))
+    marker = query.get('marker')
+    if marker is not None:
+        keys = [key(item) for item in items]
+        if marker not in keys:
+            raise GlacierFault(400, "InvalidParameterValueException",
+                               "Invalid marker: %s" % (marker,))
+        items = items[keys.index(marker) + 1:]
+    if len(items) > limit:
+        return items[:limit], key(items[limit - 1])
+    return items, None
+
+class GlacierHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    VAULT = r"^/-/vaults/([^/]+)"
+    routes = [
+        ("GET", r"^/-/vaults$", "list_vaults"),
+        ("PUT", VAULT + "$", "create_vault"),
+        ("DELETE", VAULT + "$", "delete_vault"),
+        ("GET", VAULT + "$", "describe_vault"),
+        ("POST", VAULT + "/multipart-uploads$", "initiate_upload"),
+        ("GET", VAULT + "/multipart-uploads$", "list_uploads"),
+        ("PUT", VAULT + "/multipart-uploads/([^/]+)$", "upload_part"),
+        ("GET", VAULT + "/multipart-uploads/([^/]+)$", "list_parts"),
+        ("POST", VAULT + "/multipart-uploads/([^/]+)$", "complete_upload"),
+        ("DELETE", VAULT + "/multipart-uploads/([^/]+)$", "abort_upload"),
+        ("POST", VAULT + "/archives$", "upload_archive"),
+        ("DELETE", VAULT + "/archives/([^/]+)$", "delete_archive"),
+        ("POST", VAULT + "/jobs$", "initiate_job"),
+        ("GET", VAULT + "/jobs$", "list_jobs"),
+        ("GET", VAULT + "/jobs/([^/]+)$", "describe_job"),
+        ("GET", VAULT + "/jobs/([^/]+)/output$", "get_output"),
+        ("GET", r"^/_stats$", "get_stats"),
+    ]
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_PUT(self):
+        self.dispatch("PUT")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_DELETE(self):
+        self.dispatch("DELETE")
+
+    def dispatch(self, method):
+        url = urlparse.urlparse(self.path)
+        self.query = dict(urlparse.parse_qsl(url.query))
+        self.body_read = False
+        glacier = self.server.glacier
+        try:
+            for route_method, pattern, name in self.routes:
+                match = re.match(pattern, url.path)
+                if match and route_method == method:
+                    break
+            else:
+                raise GlacierFault(404, "ResourceNotFoundException",
+                                   "No such resource: %s %s" % (method, url.path))
+            if name != "get_stats":
+                glacier.count(name)
+                if self.server.latency:
+                    time.sleep(self.server.latency)
+                if random.random() < self.server.error_rate:
+                    glacier.count("injected_errors")
+                    if random.random() < 0.5:
+                        raise GlacierFault(500, "ServiceUnavailableException",
+                                           "Injected server error")
+                    raise GlacierFault(400, "ThrottlingException", "Injected throttling")
+            getattr(self, name)(*[urllib.unquote(group) for group in match.groups()])
+        except GlacierFault, e:
+            if not self.body_read:
+                self.read_body()
+            self.send_json(e.status, {"code": e.code, "message": e.message,
+                                      "type": "Server" if e.status >= 500 else "Client"})
+
+    def throttle(self, start, done):
+        if self.server.bandwidth:
+            delay = start + float(done) / self.server.bandwidth - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def read_body(self):
+        self.body_read = True
+        length = int(self.headers.getheader('Content-Length') or 0)
+        start = time.time()
+        blocks = []
+        done = 0
+        while done < length:
+            block = self.rfile.read(min(BLOCK_SIZE, length - done))
+            if not block:
+                raise GlacierFault(400, "InvalidParameterValueException",
+                                   "Request body ended after %d bytes" % (done,))
+            blocks.append(block)
+            done += len(block)
+            self.throttle(start, done)
+        return "".join(blocks)
+
+    def send_headers(self, status, headers, length=0):
+        self.send_response(status)
+        self.send_header("x-amzn-RequestId", new_id())
+        self.send_header("Content-Length", str(length))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+
+    def send_body(self, data):
+        start = time.time()
+        for offset in xrange(0, len(data), BLOCK_SIZE):
+            self.wfile.write(data[offset:offset + BLOCK_SIZE])
+            self.throttle(start, offset + BLOCK_SIZE)
+
+    def send_json(self, status, document, headers={}):
+        body = json.dumps(document)
+        headers = dict(headers, **{"Content-Type": "application/json"})
+        self.send_headers(status, headers, len(body))
+        self.send_body(body)
+
+    def send_empty(self, status, headers={}):
+        self.send_headers(status, headers)
+
+    # Vaults
+
+    def list_vaults(self):
+        glacier = self.server.glacier
+        with glacier.lock:
+            vaults = [glacier.describe_vault(vault) for vault in glacier.vaults.values()]
+        vaults, marker = page(sorted(vaults, key=lambda v: v["VaultARN"]), self.query,
+                              lambda v: v["VaultARN"])
+        self.send_json(200, {"VaultList": vaults, "Marker": marker})
+
+    def create_vault(self, name):
+        self.server.glacier.vault(name)
+        self.send_empty(201, {"Location": "/-/vaults/%s" % (urllib.quote(name),)})
+
+    def delete_vault(self, name):
+        glacier = self.server.glacier
+        with glacier.lock:
+            vault = glacier.vault(name, create=False)
+            if vault['archives']:
+                raise GlacierFault(400, "InvalidParameterValueException",
+                                   "Vault not empty or recently written to: %s" % (name,))
+            del glacier.vaults[name]
+        self.send_empty(204)
+
+    def describe_vault(self, name):
+        glacier = self.server.glacier
+        self.send_json(200, glacier.describe_vault(glacier.vault(name, create=False)))
+
+    # Uploads
+
+    def initiate_upload(self, name):
+        vault = self.server.glacier.vault(name)
+        part_size = int(self.headers.getheader("x-amz-part-size") or 0)
+        if part_size < MB or part_size > 4096*MB or part_size & (part_size - 1):
+            raise GlacierFault(400, "InvalidParameterValueException",
+                               "Invalid part size: %d" % (part_size,))
+        upload_id = new_id()
+        upload = {'id': upload_id, 'part_size': part_size, 'created': time.time(),
+                  'description': self.headers.getheader("x-amz-archive-description") or "",
+                  'parts': {}, 'archive': None}
+        open(self.server.glacier.path(upload_id), "wb").close()
+        with self.server.glacier.lock:
+            vault['uploads'][upload_id] = upload
+        self.send_empty(201, {"Location": "/-/vaults/%s/multipart-uploads/%s"
+                                          % (urllib.quote(name), upload_id),
+                              "x-amz-multipart-upload-id": upload_id})
+
+    def list_uploads(self, name):
+        vault = self.server.glacier.vault(name, create=False)
+        uploads = [upload for upload in vault['uploads'].values() if not upload['archive']]
+        uploads, marker = page(sorted(uploads, key=lambda u: u['id']), self.query,
+                               lambda u: u['id'])
+        self.send_json(200, {"UploadsList": [
+                                {"ArchiveDescription": upload['description'],
+                                 "CreationDate": iso_date(upload['created']),
+                                 "MultipartUploadId": upload['id'],
+                                 "PartSizeInBytes": upload['part_size'],
+                                 "VaultARN": ACCOUNT_ARN + name} for upload in uploads],
+                             "Marker": marker})
+
+    def upload_part(self, name, upload_id):
+        glacier = self.server.glacier
+        upload = glacier.find(glacier.vault(name, create=False), 'uploads', upload_id)
+        match = re.match(r"bytes (\d+)-(\d+)/\*", self.headers.getheader("Content-Range") or "")
+        if not match:
+            raise GlacierFault(400, "InvalidParameterValueException", "Missing Content-Range")
+        start, end = int(match.group(1)), int(match.group(2))
+        data = self.read_body()
+        if len(data) != end - start + 1:
+            raise GlacierFault(400, "InvalidParameterValueException",
+                               "Content-Range does not match the body")
+        if start % upload['part_size'] or len(data) > upload['part_size']:
+            raise GlacierFault(400, "InvalidParameterValueException",
+                               "Part is not aligned to the part size")
+        chunks = glaciercorecalls.chunk_hashes(data)
+        tree_hash = glaciercorecalls.bytes_to_hex(glaciercorecalls.tree_hash(chunks))
+        if tree_hash != self.headers.getheader("x-amz-sha256-tree-hash"):
+            raise GlacierFault(400, "InvalidParameterValueException",
+                               "Tree hash of the part does not match the data")
+        with open(glacier.path(upload_id), "r+b") as fo:
+            fo.seek(start)
+            fo.write(data)
+        with glacier.lock:
+            upload['parts'][start] = (len(data), tree_hash, chunks)
+        self.send_empty(204, {"x-amz-sha256-tree-hash": tree_hash})
+
+    def list_parts(self, name, upload_id):
+        glacier = self.server.glacier
+        upload = glacier.find(glacier.vault(name, create=False), 'uploads', upload_id)
+        with glacier.lock:
+            offsets = sorted(upload['parts'])
+        offsets, marker = page(offsets, self.query, str)
+        parts = []
+        for offset in offsets:
+            size, tree_hash, chunks = upload['parts'][offset]
+            parts.append({"RangeInBytes": "%d-%d" % (offset, offset + size - 1),
+                          "SHA256TreeHash": tree_hash})
+        self.send_json(200, {"ArchiveDescription": upload['description'],
+                             "CreationDate": iso_date(upload['created']),
+                             "Marker": marker,
+                             "MultipartUploadId": upload_id,
+                             "PartSizeInBytes": upload['part_size'],
+                             "Parts": parts,
+                             "VaultARN": ACCOUNT_ARN + name})
+
+    def complete_upload(self, name, upload_id):
+        glacier = self.server.glacier
+        vault = glacier.vault(name, create=False)
+        upload = glacier.find(vault, 'uploads', upload_id)
+        expected_hash = self.headers.getheader("x-amz-sha256-tree-hash")
+        with glacier.lock:
+            # Like Glacier, forget the upload once it is completed: a retried
+            # complete request gets a 404, not the archive.
+            if upload_id not in vault['uploads']:
+                raise GlacierFault(404, "ResourceNotFoundException",
+                                   "No such upload: %s" % (upload_id,))
+            size = int(self.headers.getheader("x-amz-archive-size") or 0)
+            chunks = []
+            offset = 0
+            for start in sorted(upload['parts']):
+                part_size, tree_hash, part_chunks = upload['parts'][start]
+                if start != offset:
+                    break
+                chunks.extend(part_chunks)
+                offset += part_size
+            if offset != size or not chunks:
+                raise GlacierFault(400, "InvalidParameterValueException",
+                                   "Parts do not cover the archive size %d" % (size,))
+            path = glacier.path(upload_id)
+            with open(path, "r+b") as fo:
+                fo.truncate(size)
+            archive = upload['archive'] = glacier.add_archive(vault, path, upload['description'],
+                                                              chunks, expected_hash)
+            del vault['uploads'][upload_id]
+        self.send_empty(201, {"Location": "/-/vaults/%s/archives/%s"
+                                          % (urllib.quote(name), archive['id']),
+                              "x-amz-archive-id": archive['id'],
+                              "x-amz-sha256-tree-hash": archive['tree_hash']})
+
+    def abort_upload(self, name, upload_id):
+        glacier = self.server.glacier
+        vault = glacier.vault(name, create=False)
+        glacier.find(vault, 'uploads', upload_id)
+        with glacier.lock:
+            del vault['uploads'][upload_id]
+        os.remove(glacier.path(upload_id))
+        self.send_empty(204)
+
+    def upload_archive(self, name):
+        glacier = self.server.glacier
+        vault = glacier.vault(name)
+        data = self.read_body()
+        if not data:
+            raise GlacierFault(400, "InvalidParameterValueException", "Empty archive")
+        path = glacier.path(new_id())
+        with open(path, "wb") as fo:
+            fo.write(data)
+        archive = glacier.add_archive(vault, path,
+                                      self.headers.getheader("x-amz-archive-description") or "",
+                                      glaciercorecalls.chunk_hashes(data),
+                                      self.headers.getheader("x-amz-sha256-tree-hash"))
+        self.send_empty(201, {"Location": "/-/vaults/%s/archives/%s"
+                                          % (urllib.quote(name), archive['id']),
+                              "x-amz-archive-id": archive['id'],
+                              "x-amz-sha256-tree-hash": archive['tree_hash']})
+
+    def delete_archive(self, name, archive_id):
+        glacier = self.server.glacier
+        vault = glacier.vault(name, create=False)
+        glacier.find(vault, 'archives', archive_id)
+        with glacier.lock:
+            del vault['archives'][archive_id]
+        os.remove(glacier.path(archive_id))
+        self.send_empty(204)
+
+    # Jobs
+
+    def initiate_job(self, name):
+        glacier = self.server.glacier
+        vault = glacier.vault(name, create=False)
+        try:
+            params = json.loads(self.read_body())
+        except ValueError:
+            raise GlacierFault(400, "InvalidParameterValueException", "Invalid JSON")
+        now = time.time()
+        job = {'id': new_id(), 'created': now, 'completes': now + glacier.job_delay,
+               'description': params.get("Description"), 'sns_topic': params.get("SNSTopic"),
+               'archive': None, 'inventory': None}
+        if params.get("Type") == "archive-retrieval":
+            job['action'] = "ArchiveRetrieval"
+            job['archive'] = glacier.find(vault, 'archives', params.get("ArchiveId"))
+        elif params.get("Type") == "inventory-retrieval":
+            job['action'] = "InventoryRetrieval"
+            job['inventory'] = glacier.inventory(vault)
+        else:
+            raise GlacierFault(400, "InvalidParameterValueException",
+                               "Unknown job type: %s" % (params.get("Type"),))
+        with glacier.lock:
+            vault['jobs'][job['id']] = job
+        self.send_empty(202, {"Location": "/-/vaults/%s/jobs/%s" % (urllib.quote(name), job['id']),
+                              "x-amz-job-id": job['id']})
+
+    def list_jobs(self, name):
+        glacier = self.server.glacier
+        vault = glacier.vault(name, create=False)
+        with glacier.lock:
+            jobs = [glacier.describe_job(vault, job) for job in vault['jobs'].values()]
+        if 'completed' in self.query:
+            completed = self.query['completed'] == 'true'
+            jobs = [job for job in jobs if job["Completed"] == completed]
+        if 'statuscode' in self.query:
+            jobs = [job for job in jobs if job["StatusCode"] == self.query['statuscode']]
+        jobs.sort(key=lambda job: (job["CreationDate"], job["JobId"]))
+        jobs, marker = page(jobs, self.query, lambda job: job["JobId"])
+        self.send_json(200, {"JobList": jobs, "Marker": marker})
+
+    def describe_job(self, name, job_id):
+        glacier = self.server.glacier
+        vault = glacier.vault(name, create=False)
+        self.send_json(200, glacier.describe_job(vault, glacier.find(vault, 'jobs', job_id)))
+
+    def get_output(self, name, job_id):
+        glacier = self.server.glacier
+        job = glacier.find(glacier.vault(name, create=False), 'jobs', job_id)
+        if time.time() < job['completes']:
+            raise GlacierFault(400, "InvalidParameterValueException",
+                               "The job is not currently available for download: %s" % (job_id,))
+        if job['inventory'] is not None:
+            return self.send_json(200, json.loads(job['inventory']))
+
+        archive = job['archive']
+        size = archive['size']
+        start, end = 0, size - 1
+        status = 200
+        headers = {"Content-Type": "application/octet-stream"}
+        match = re.match(r"bytes=(\d+)-(\d+)$", self.headers.getheader("Range") or "")
+        if match:
+            start, end = int(match.group(1)), min(int(match.group(2)), size - 1)
+            if start > end:
+                raise GlacierFault(416, "InvalidParameterValueException", "Invalid range")
+            status = 206
+            headers["Content-Range"] = "bytes %d-%d/%d" % (start, end, size)
+        # Like Glacier, only send a tree hash for ranges made of whole chunks.
+        if start % MB == 0 and ((end + 1) % MB == 0 or end == size - 1):
+            chunks = archive['chunks'][start // MB:(end + MB) // MB]
+            headers["x-amz-sha256-tree-hash"] = glaciercorecalls.bytes_to_hex(
+                                                    glaciercorecalls.tree_hash(chunks))
+        self.send_headers(status, headers, end - start + 1)
+        with open(glacier.path(archive['id']), "rb") as fo:
+            fo.seek(start)
+            remaining = end - start + 1
+            begin = time.time()
+            while remaining:
+                block = fo.read(min(BLOCK_SIZE, remaining))
+                self.wfile.write(block)
+                remaining -= len(block)
+                self.throttle(begin, end - start + 1 - remaining)
+
+    def get_stats(self):
+        self.send_json(200, self.server.glacier.stats())
+
+class FakeGlacierServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, latency=0, bandwidth=None, error_rate=0, job_delay=0,
+                 directory=None, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port), GlacierHandler)
+        self.latency = latency
+        self.bandwidth = bandwidth and bandwidth * MB
+        self.error_rate = error_rate
+        self.verbose = verbose
+        self.cleanup = directory is None
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.glacier = FakeGlacier(directory or tempfile.mkdtemp(prefix="fakeglacier-"),
+                                   job_delay)
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % (self.server_port,)
+
+    def start(self):
+        """
+        Serve from a background thread, for use in the same process.
+        """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.cleanup:
+            shutil.rmtree(self.glacier.directory, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Glacier endpoint on localhost")
+    parser.add_argument('--port', type=int, default=8080,
+                        help="Port to listen on, 0 picks a free one.")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="Seconds to wait before handling each request.")
+    parser.add_argument('--bandwidth', type=float, default=None,
+                        help="MB/s per connection for request and response bodies.")
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help="Fraction of requests answered with a 500 or a throttling error.")
+    parser.add_argument('--job-delay', type=float, default=0,
+                        help="Seconds until retrieval jobs complete.")
+    parser.add_argument('--directory', default=None,
+                        help="Where to keep archives, a temporary directory by default.")
+    parser.add_argument('--verbose', action='store_true', help="Log every request.")
+    args = parser.parse_args()
+
+    server = FakeGlacierServer(args.port, args.latency, args.bandwidth, args.error_rate,
+                               args.job_delay, args.directory, args.verbose)
+    print "Fake Glacier listening on %s" % (server.url,)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if server.cleanup:
+            shutil.rmtree(server.glacier.directory, ignore_errors=True)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -34,19 +34,31 @@ import ConfigParser
 import argparse
 import re
 import json
+import urlparse
+import csv
+import collections
 import datetime
 import dateutil.parser
 import pytz
 import locale
 import time
+import hashlib
+import mmap
+import sqlite3
+import multiprocessing
 from prettytable import PrettyTable
 
 import boto
+from multiprocessing.pool import ThreadPool
 import glaciercorecalls
+import glaciercatalog
 
 MAX_VAULT_NAME_LENGTH = 255
 VAULT_NAME_ALLOWED_CHARACTERS = "[a-zA-Z\.\-\_0-9]+"
 READ_PART_SIZE = glaciercorecalls.GlacierWriter.DEFAULT_PART_SIZE
+JOURNAL_DIR = os.path.expanduser("~/.glacier-journal")
+CATALOG = os.path.expanduser("~/.glacier-catalog.db")
+HASH_WORKERS = multiprocessing.cpu_count()
 locale.setlocale(locale.LC_ALL, '') # Empty string = use default setting
 
 def progress(msg):
@@ -66,17 +78,16 @@ def check_vault_name(name):
     return True
 
 MAX_DESCRIPTION_LENGTH = 1024
+DESCRIPTION_INVALID_CHARACTERS = re.compile(r"[^\x20-\x7e]")
 
 def check_description(description):
-    if len(description) > 1024:
+    if len(description) > MAX_DESCRIPTION_LENGTH:
         raise Exception(u"Description must be less or equal to 1024 characters.")
 
-    for char in description:
-        n = ord(char)
-        if n < 32 or n > 126:
-            raise Exception(u"The allowable characters are 7-bit ASCII without \
-                              control codes, specifically ASCII values 32—126 \
-                              decimal or 0x20—0x7E hexadecimal.")
+    if DESCRIPTION_INVALID_CHARACTERS.search(description):
+        raise Exception(u"The allowable characters are 7-bit ASCII without \
+                          control codes, specifically ASCII values 32—126 \
+                          decimal or 0x20—0x7E hexadecimal.")
     return True
 
 def is_power_of_2(v):
@@ -101,6 +112,28 @@ def print_headers(response):
             table.add_row(header)
     print table
 
+def connect(args, region):
+    """
+    Connection to Glacier in region, or to the --endpoint URL if one
+    was given (e.g. the fake server in benchmarks/fakeglacier.py).
+    """
+    kwargs = {}
+    if args.endpoint:
+        url = urlparse.urlparse(args.endpoint)
+        kwargs = {'host': url.hostname, 'port': url.port,
+                  'is_secure': url.scheme != 'http'}
+    return glaciercorecalls.GlacierConnection(args.aws_access_key, args.aws_secret_key,
+                                              region=region, **kwargs)
+
+def get_bookkeeping_domain(args):
+    sdb_conn = boto.connect_sdb(aws_access_key_id=args.aws_access_key,
+                                aws_secret_access_key=args.aws_secret_key)
+    domain_name = args.bookkeeping_domain_name
+    try:
+        return sdb_conn.get_domain(domain_name, validate=True)
+    except boto.exception.SDBResponseError:
+        return sdb_conn.create_domain(domain_name)
+
 def parse_response(response):
     if response.status == 403:
         print "403 Forbidden."
@@ -114,7 +147,7 @@ def parse_response(response):
 
 def lsvault(args):
     region = args.region
-    glacierconn = glaciercorecalls.GlacierConnection(args.aws_access_key, args.aws_secret_key, region=region)
+    glacierconn = connect(args, region)
 
     response = glacierconn.list_vaults()
     table = None
@@ -143,7 +176,7 @@ def mkvault(args):
     vault_name = args.vault
     region = args.region
 
-    glacierconn = glaciercorecalls.GlacierConnection(args.aws_access_key, args.aws_secret_key, region=region)
+    glacierconn = connect(args, region)
 
     if check_vault_name(vault_name):
         response = glaciercorecalls.GlacierVault(glacierconn, vault_name).create_vault()
@@ -154,7 +187,7 @@ def rmvault(args):
     vault_name = args.vault
     region = args.region
 
-    glacierconn = glaciercorecalls.GlacierConnection(args.aws_access_key, args.aws_secret_key, region=region)
+    glacierconn = connect(args, region)
 
     if check_vault_name(vault_name):
         response = glaciercorecalls.GlacierVault(glacierconn, vault_name).delete_vault()
@@ -164,7 +197,7 @@ def describevault(args):
     vault_name = args.vault
     region = args.region
 
-    glacierconn = glaciercorecalls.GlacierConnection(args.aws_access_key, args.aws_secret_key, region=region)
+    glacierconn = connect(args, region)
 
     if check_vault_name(vault_name):
         response = glaciercorecalls.GlacierVault(glacierconn, vault_name).describe_vault()
@@ -180,10 +213,11 @@ def listmultiparts(args):
     vault_name = args.vault
     region = args.region
 
-    glacierconn = glaciercorecalls.GlacierConnection(args.aws_access_key, args.aws_secret_key, region=region)
+    glacierconn = connect(args, region)
 
     if check_vault_name(vault_name):
-        response = glaciercorecalls.GlacierVault(glacierconn, vault_name).list_multipart_uploads()
+        gv = glaciercorecalls.GlacierVault(glacierconn, vault_name)
+        response = gv.list_multipart_uploads()
         table = None
         while True:
             parse_response(response)
@@ -197,7 +231,7 @@ def listmultiparts(args):
                     table.add_row([locale.format('%d', entry[k], grouping=True) if k == 'PartSizeInBytes'
                                    else entry[k] for k in headers ])
                 if jdata['Marker']:
-                    response = glaciercorecalls.GlacierVault(glacierconn, vault_name).list_multipart_uploads(jdata['Marker'])
+                    response = gv.list_multipart_uploads(jdata['Marker'])
                 else:
                     break
             else:
@@ -210,7 +244,7 @@ def abortmultipart(args):
     vault_name = args.vault
     region = args.region
 
-    glacierconn = glaciercorecalls.GlacierConnection(args.aws_access_key, args.aws_secret_key, region=region)
+    glacierconn = connect(args, region)
 
     if check_vault_name(vault_name):
         response = glaciercorecalls.GlacierVault(glacierconn, vault_name).abort_multipart(args.uploadId)
@@ -220,14 +254,12 @@ def listjobs(args):
     vault_name = args.vault
     region = args.region
 
-    glacierconn = glaciercorecalls.GlacierConnection(args.aws_access_key, args.aws_secret_key, region=region)
+    glacierconn = connect(args, region)
 
     gv = glaciercorecalls.GlacierVault(glacierconn, name=vault_name)
-    response = gv.list_jobs()
-    parse_response(response)
     table = PrettyTable(["Action", "Archive ID", "Status", "Initiated",
                          "VaultARN", "Job ID"])
-    for job in gv.job_list:
+    for job in gv.iter_jobs(status_code=args.status, limit=args.page_size):
         table.add_row([job['Action'],
                        job['ArchiveId'],
                        job['StatusCode'],
@@ -240,7 +272,7 @@ def describejob(args):
     vault = args.vault
     jobid = args.jobid
     region = args.region
-    glacierconn = glaciercorecalls.GlacierConnection(args.aws_access_key, args.aws_secret_key, region=region)
+    glacierconn = connect(args, region)
 
     gv = glaciercorecalls.GlacierVault(glacierconn, vault)
     gj = glaciercorecalls.GlacierJob(gv, job_id=jobid)
@@ -259,6 +291,417 @@ def size_fmt(num, decimals = 1):
         num /= 1024.0
     return fmt % (num, 'TB')
 
+def get_part_size(total_size, partsize=-1):
+    """
+    Part size in MB for an archive of total_size bytes: the requested
+    size rounded up to a power of two, or the smallest one that fits the
+    archive in 10,000 parts.
+    """
+    if partsize < 0:
+        # User did not specify part_size. Compute the optimal value.
+        if total_size > 0:
+            part_size = max(1, next_power_of_2(total_size / (1024*1024*10000)))
+        else:
+            part_size = glaciercorecalls.GlacierWriter.DEFAULT_PART_SIZE / 1024 / 1024
+    else:
+        part_size = next_power_of_2(partsize)
+
+    if total_size > part_size * 1024 * 1024 * 10000:
+        # User specified a value that is too small. Adjust.
+        part_size = next_power_of_2(total_size / (1024*1024*10000))
+    return part_size
+
+def batch_files(paths, manifest=None):
+    """
+    Files to upload in a batch: the given files, every file under the
+    given directories, and the files listed in manifest, one per line.
+    """
+    if manifest:
+        f = sys.stdin if manifest == "-" else open(manifest)
+        paths = paths + [line.rstrip("\r\n") for line in f if line.strip()]
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files.extend(os.path.join(root, name) for name in sorted(names))
+        else:
+            files.append(path)
+    return files
+
+def upload_file(glacierconn, region, vault, filename, partsize=-1):
+    """
+    Upload one file as an archive described by its name, and return its
+    catalog entry.
+    """
+    check_description(filename)
+    total_size = os.path.getsize(filename)
+    if total_size == 0:
+        raise Exception(u"Glacier can't store empty archives.")
+    writer = glaciercorecalls.GlacierWriter(glacierconn, vault, description=filename,
+                                            part_size=get_part_size(total_size, partsize)*1024*1024)
+    with open(filename, 'rb') as reader:
+        mapping = mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for offset in xrange(0, total_size, writer.part_size):
+                writer.write_mapped(mapping, offset, min(writer.part_size, total_size - offset))
+        finally:
+            mapping.close()
+    writer.close()
+    return {'region': region,
+            'vault': vault,
+            'filename': filename,
+            'archive_id': writer.get_archive_id(),
+            'location': writer.get_location(),
+            'description': filename,
+            'date': '%s' % datetime.datetime.utcnow().replace(tzinfo=pytz.utc),
+            'hash': writer.get_hash(),
+            'size': writer.uploaded_size}
+
+def find_duplicate(catalog, region, vault, filename, hash_workers=1):
+    """
+    Look up the tree hash of filename among the archives in the vault the
+    catalog knows about. If the content is already stored, map filename
+    to that archive and return it; otherwise return None.
+    """
+    file_hash = glaciercorecalls.bytes_to_hex(
+                    glaciercorecalls.file_tree_hash(filename, hash_workers))
+    archive = catalog.find_hash(region, vault, file_hash)
+    if archive is not None and archive['filename'] != filename:
+        catalog.add_members(archive['archive_id'],
+                            [{'filename': filename,
+                              'offset': 0,
+                              'size': os.path.getsize(filename),
+                              'hash': file_hash}])
+    return archive
+
+# Uploaded archives are written to the catalog this many at a time.
+BATCH_CATALOG_SIZE = 100
+
+def putarchive_batch(args):
+    """
+    Upload many files from one process: args.batch_workers files at a
+    time, all over the same connection pool, recording them in the
+    catalog (and SimpleDB) in bulk.
+    """
+    vault = args.vault
+    files = batch_files(([args.filename] if args.filename else []) + args.description,
+                        args.manifest)
+    if not files:
+        print "Nothing to upload."
+        return False
+
+    glacierconn = connect(args, args.region)
+    glacierconn.connection_pool.reserve(args.batch_workers)
+    if args.bookkeeping:
+        domain = ThreadPool(1).apply_async(get_bookkeeping_domain, (args,))
+    catalog = glaciercatalog.GlacierCatalog(args.catalog)
+    interrupted = []
+
+    def upload(filename):
+        if interrupted:
+            return filename, None, None
+        try:
+            if args.dedup and find_duplicate(catalog, args.region, vault, filename):
+                return filename, None, None
+            return (filename, upload_file(glacierconn, args.region, vault, filename,
+                                          args.partsize), None)
+        except Exception, e:
+            return filename, None, e
+
+    start_time = time.time()
+    uploaded = []
+    failed = []
+    skipped = 0
+    total_bytes = 0
+    recorded = 0
+    pool = ThreadPool(args.batch_workers)
+    results = pool.imap_unordered(upload, files)
+    try:
+        for filename, file_attrs, error in results:
+            if error is not None:
+                failed.append((filename, error))
+                print "\nFailed to upload %s: %s" % (filename, error)
+            elif file_attrs is None:
+                skipped += 1
+            else:
+                uploaded.append(file_attrs)
+                total_bytes += file_attrs['size']
+                progress('\n')
+                print "Created archive with ID: %s for %s" % (file_attrs['archive_id'], filename)
+                if len(uploaded) - recorded == BATCH_CATALOG_SIZE:
+                    catalog.add_archives(uploaded[recorded:])
+                    recorded = len(uploaded)
+            progress('\rUploaded %d of %d files (%s), %d already stored, %d failed.' %
+                     (len(uploaded), len(files), size_fmt(total_bytes), skipped, len(failed)))
+    except KeyboardInterrupt:
+        # Start no more uploads, but let the running ones finish so their
+        # archives are recorded too.
+        interrupted.append(True)
+        print "\nInterrupted, waiting for the uploads in progress to finish."
+        for filename, file_attrs, error in results:
+            if file_attrs is not None:
+                uploaded.append(file_attrs)
+                print "Created archive with ID: %s for %s" % (file_attrs['archive_id'], filename)
+        raise
+    finally:
+        # These archives are in the vault already, even if the batch was
+        # interrupted; without a catalog entry nobody would find them.
+        catalog.add_archives(uploaded[recorded:])
+    pool.close()
+    if args.bookkeeping:
+        catalog.sync_simpledb(domain.get(), pull=False)
+
+    elapsed = max(time.time() - start_time, 0.001)
+    print "\nUploaded %d files (%s) in %.1fs: %.1f files/s, %s/s." % (
+            len(uploaded), size_fmt(total_bytes), elapsed,
+            len(uploaded) / elapsed, size_fmt(total_bytes / elapsed, 2))
+    if skipped:
+        print "%d files were already stored and skipped." % (skipped,)
+    if failed:
+        print "%d files failed:" % (len(failed),)
+        for filename, error in failed:
+            print "  %s: %s" % (filename, error)
+        return False
+    return True
+
+def putarchive_pack(args):
+    """
+    Stream many small files into a single archive, recording the offset,
+    size and tree hash of each one in the catalog so it can be fetched on
+    its own with download later. Paths that aren't readable files are left
+    out of the pack and reported, and make the command fail.
+    """
+    region = args.region
+    vault = args.vault
+    files = []
+    skipped = []
+    for filename in batch_files(([args.filename] if args.filename else []) + args.description,
+                                args.manifest):
+        if not os.path.exists(filename):
+            skipped.append((filename, "no such file"))
+        elif not os.path.isfile(filename):
+            skipped.append((filename, "not a regular file"))
+        elif not os.access(filename, os.R_OK):
+            skipped.append((filename, "not readable"))
+        else:
+            files.append(filename)
+    for filename, reason in skipped:
+        print >> sys.stderr, "Skipping %s: %s." % (filename, reason)
+    total_size = sum(os.path.getsize(filename) for filename in files)
+    if total_size == 0:
+        print "Nothing to upload."
+        return False
+    name = args.name or "pack-%s" % (datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%SZ"),)
+    check_description(name)
+
+    glacierconn = connect(args, region)
+    if args.bookkeeping:
+        domain = ThreadPool(1).apply_async(get_bookkeeping_domain, (args,))
+    catalog = glaciercatalog.GlacierCatalog(args.catalog)
+
+    writer = glaciercorecalls.GlacierWriter(glacierconn, vault, description=name,
+                                            part_size=get_part_size(total_size, args.partsize)*1024*1024,
+                                            concurrency=args.concurrency,
+                                            hash_workers=args.hash_workers)
+    # Members are recorded under the upload ID until the archive ID is known.
+    members = []
+    count = 0
+    try:
+        for filename in files:
+            offset = writer.hasher.size
+            hasher = glaciercorecalls.TreeHasher(linear=False)
+            with open(filename, 'rb') as reader:
+                for block in iter((lambda:reader.read(1024*1024)), ''):
+                    hasher.update(block)
+                    writer.write(block)
+            members.append({'filename': filename,
+                            'offset': offset,
+                            'size': writer.hasher.size - offset,
+                            'hash': glaciercorecalls.bytes_to_hex(hasher.tree_hash())})
+            count += 1
+            if len(members) == BATCH_CATALOG_SIZE:
+                catalog.add_members(writer.upload_id, members)
+                members = []
+            progress('\rPacked %d of %d files, %s of %s.' %
+                     (count, len(files), size_fmt(writer.hasher.size), size_fmt(total_size)))
+        catalog.add_members(writer.upload_id, members)
+        writer.close()
+    except:
+        catalog.finish_pack(writer.upload_id)
+        raise
+    progress('\n')
+
+    archive_id = writer.get_archive_id()
+    catalog.add_archive(region=region,
+                        vault=vault,
+                        filename=name,
+                        archive_id=archive_id,
+                        location=writer.get_location(),
+                        description=name,
+                        date='%s' % datetime.datetime.utcnow().replace(tzinfo=pytz.utc),
+                        hash=writer.get_hash(),
+                        size=writer.uploaded_size)
+    catalog.finish_pack(writer.upload_id, archive_id)
+    if args.bookkeeping:
+        catalog.sync_simpledb(domain.get(), pull=False)
+
+    print "Created pack archive %s of %d files with ID: %s" % (name, count, archive_id)
+    print "Archive SHA256 tree hash: ", writer.get_hash()
+    if skipped:
+        print "%d files were skipped and aren't in the pack." % (len(skipped),)
+        return False
+    return True
+
+# Incremental uploads compare and store files in chunks of this size.
+CHUNK_SIZE = glaciercorecalls.TreeHasher.CHUNK_SIZE
+
+def putarchive_incremental(args):
+    """
+    Upload only the 1MB chunks of a file that changed since its previous
+    version, as a delta archive, and record a manifest of the archive and
+    offset every chunk of the new version is stored at. The first version
+    uploads every chunk.
+    """
+    region = args.region
+    vault = args.vault
+    filename = os.path.abspath(args.filename)
+    total_size = os.path.getsize(filename)
+    if total_size == 0:
+        raise Exception(u"Glacier can't store empty archives.")
+
+    catalog = glaciercatalog.GlacierCatalog(args.catalog)
+    previous = catalog.get_version(region, vault, filename)
+    old_chunks = catalog.version_chunks(previous['id']) if previous else []
+    version = previous['version'] + 1 if previous else 1
+
+    with open(filename, 'rb') as reader:
+        mapping = mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            digests = glaciercorecalls.chunk_hashes(buffer(mapping), args.hash_workers)
+            hashes = [glaciercorecalls.bytes_to_hex(digest) for digest in digests]
+            changed = [i for i, chunk_hash in enumerate(hashes)
+                       if i >= len(old_chunks) or old_chunks[i][0] != chunk_hash]
+            if previous and not changed and previous['size'] == total_size:
+                print "%s is unchanged since version %d." % (filename, previous['version'])
+                return True
+
+            delta_size = sum(min(CHUNK_SIZE, total_size - i*CHUNK_SIZE) for i in changed)
+            description = "%s version %d" % (filename, version)
+            # A file cut short at a chunk boundary has no changed chunks,
+            # its new version only drops some of the old ones.
+            if changed:
+                glacierconn = connect(args, region)
+                if args.bookkeeping:
+                    domain = ThreadPool(1).apply_async(get_bookkeeping_domain, (args,))
+                check_description(description)
+                writer = glaciercorecalls.GlacierWriter(glacierconn, vault, description=description,
+                                                        part_size=get_part_size(delta_size, args.partsize)*1024*1024,
+                                                        concurrency=args.concurrency,
+                                                        hash_workers=args.hash_workers)
+                for count, i in enumerate(changed):
+                    offset = i*CHUNK_SIZE
+                    writer.write(buffer(mapping, offset, min(CHUNK_SIZE, total_size - offset)))
+                    progress('\rWrote %d of %d changed chunks.' % (count + 1, len(changed)))
+                writer.close()
+                progress('\n')
+        finally:
+            mapping.close()
+
+    date = '%s' % datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+    archive_id = None
+    if changed:
+        archive_id = writer.get_archive_id()
+        catalog.add_archive(region=region,
+                            vault=vault,
+                            filename=description,
+                            archive_id=archive_id,
+                            location=writer.get_location(),
+                            description=description,
+                            date=date,
+                            hash=writer.get_hash(),
+                            size=delta_size)
+    # Chunks are stored in the delta archive in the order they were written.
+    delta_offsets = dict((i, n*CHUNK_SIZE) for n, i in enumerate(changed))
+    chunks = [(chunk_hash, archive_id, delta_offsets[i]) if i in delta_offsets
+              else old_chunks[i]
+              for i, chunk_hash in enumerate(hashes)]
+    catalog.add_version(region, vault, filename, total_size,
+                        glaciercorecalls.bytes_to_hex(glaciercorecalls.tree_hash(digests)),
+                        date, chunks)
+    if args.bookkeeping and changed:
+        catalog.sync_simpledb(domain.get(), pull=False)
+
+    print "Stored version %d of %s: %d of %d chunks changed, %s uploaded." % (
+            version, filename, len(changed), len(hashes), size_fmt(delta_size))
+    if archive_id:
+        print "Created archive with ID: ", archive_id
+    return True
+
+def rebuild(args):
+    """
+    Rebuild a version of an incrementally uploaded file from the archives
+    its chunks are stored in, fetching every run of consecutive chunks
+    with one ranged request. Retrieval jobs are started for archives that
+    don't have one yet.
+    """
+    region = args.region
+    vault = args.vault
+    filename = os.path.abspath(args.filename)
+    out_file = args.out_file or os.path.basename(filename)
+
+    catalog = glaciercatalog.GlacierCatalog(args.catalog)
+    version = catalog.get_version(region, vault, filename, args.version)
+    if version is None:
+        print "No versions of %s in vault %s." % (filename, vault)
+        return False
+    chunks = catalog.version_chunks(version['id'])
+    needed = set(archive_id for chunk_hash, archive_id, offset in chunks)
+
+    glacierconn = connect(args, region)
+    gv = glaciercorecalls.GlacierVault(glacierconn, vault)
+    done = {}
+    running = set()
+    for job in gv.iter_jobs():
+        if job['ArchiveId'] in needed:
+            if job['Completed'] and job['StatusCode'] == "Succeeded":
+                done[job['ArchiveId']] = job['JobId']
+            elif not job['Completed']:
+                running.add(job['ArchiveId'])
+    waiting = needed - set(done)
+    if waiting:
+        for archive_id in waiting - running:
+            gv.retrieve_archive(archive_id)
+        print "Waiting for Amazon Glacier to assamble %d of %d archives, started %d jobs." % (
+                len(waiting), len(needed), len(waiting - running))
+        return True
+
+    # Group consecutive chunks stored next to each other in one archive.
+    runs = []
+    for i, (chunk_hash, archive_id, offset) in enumerate(chunks):
+        if runs and runs[-1][0] == archive_id and runs[-1][1] + runs[-1][3]*CHUNK_SIZE == offset:
+            runs[-1][3] += 1
+        else:
+            runs.append([archive_id, offset, i, 1])
+
+    with open(out_file, "wb") as out:
+        for archive_id, offset, first, count in runs:
+            sizes = [min(CHUNK_SIZE, version['size'] - i*CHUNK_SIZE)
+                     for i in range(first, first + count)]
+            job = glaciercorecalls.GlacierJob(gv, job_id=done[archive_id])
+            response = job.get_output(offset, offset + sum(sizes) - 1)
+            for i, size in zip(range(first, first + count), sizes):
+                data = response.read(size)
+                if len(data) != size or hashlib.sha256(data).hexdigest() != chunks[i][0]:
+                    raise Exception(u"Chunk %d of %s from archive %s doesn't match its hash."
+                                    % (i, filename, archive_id))
+                out.write(data)
+            progress('\rWrote %d of %d chunks.' % (first + count, len(chunks)))
+    progress('\n')
+    print "Rebuilt version %d of %s (%s) from %d archives in %d requests." % (
+            version['version'], filename, size_fmt(version['size']), len(needed), len(runs))
+    return True
+
 def putarchive(args):
     region = args.region
     vault = args.vault
@@ -266,18 +709,22 @@ def putarchive(args):
     description = args.description
     stdin = args.stdin
     BOOKKEEPING= args.bookkeeping
-    BOOKKEEPING_DOMAIN_NAME= args.bookkeeping_domain_name
 
-    glacierconn = glaciercorecalls.GlacierConnection(args.aws_access_key, args.aws_secret_key, region=region)
+    if args.incremental:
+        return putarchive_incremental(args)
+    if args.pack:
+        return putarchive_pack(args)
+    if args.batch or args.manifest:
+        return putarchive_batch(args)
+    if not filename:
+        print "No file given."
+        return False
+
+    glacierconn = connect(args, region)
 
     if BOOKKEEPING:
-        sdb_conn = boto.connect_sdb(aws_access_key_id=args.aws_access_key,
-                                    aws_secret_access_key=args.aws_secret_key)
-        domain_name = BOOKKEEPING_DOMAIN_NAME
-        try:
-            domain = sdb_conn.get_domain(domain_name, validate=True)
-        except boto.exception.SDBResponseError:
-            domain = sdb_conn.create_domain(domain_name)
+        # Look up the SimpleDB domain in the background, while uploading.
+        domain = ThreadPool(1).apply_async(get_bookkeeping_domain, (args,))
 
     if description:
         description = " ".join(description)
@@ -302,32 +749,121 @@ def putarchive(args):
             print "Nothing to upload."
             return False
 
-        if args.partsize < 0:
-            # User did not specify part_size. Compute the optimal value.
-            if total_size > 0:
-                part_size = max(1, next_power_of_2(total_size / (1024*1024*10000)))
-            else:
-                part_size = glaciercorecalls.GlacierWriter.DEFAULT_PART_SIZE / 1024 / 1024
-        else:
-            part_size = next_power_of_2(args.partsize)
-
-        if total_size > part_size * 1024 * 1024 * 10000:
-            # User specified a value that is too small. Adjust.
-            part_size = next_power_of_2(total_size / (1024*1024*10000))
+        part_size = get_part_size(total_size, args.partsize)
+        concurrency = args.concurrency
+        catalog = glaciercatalog.GlacierCatalog(args.catalog)
+
+        tuner = None
+        if args.auto_tune:
+            tuner = glaciercorecalls.UploadTuner(catalog.get_transfer_stats(region),
+                                                 max_memory=args.max_memory*1024*1024)
+            tuned_size = tuner.part_size(total_size) / 1024 / 1024
+            if args.partsize < 0:
+                part_size = tuned_size
+                if stdin:
+                    # The size isn't known, so keep room for big archives.
+                    part_size = max(part_size, get_part_size(0))
+            concurrency = tuner.concurrency
+            print "Tuned upload: %d MB parts, starting with %d connections." % (part_size,
+                                                                               concurrency)
+
+        if args.dedup and not stdin:
+            archive = find_duplicate(catalog, region, vault, filename, args.hash_workers)
+            if archive is not None:
+                print "Already stored as archive with ID: ", archive['archive_id']
+                return True
+
+        journal = None
+        upload_id = None
+        done_parts = {}
+        read_size = READ_PART_SIZE
+        if args.resume:
+            if stdin:
+                print "Only uploads of regular files can be resumed."
+                return False
+            journal_header = {'vault': vault,
+                              'filename': os.path.abspath(filename),
+                              'size': total_size,
+                              'mtime': int(os.path.getmtime(filename))}
+            journal = glaciercorecalls.UploadJournal.find(JOURNAL_DIR, **journal_header)
+            if journal:
+                gv = glaciercorecalls.GlacierVault(glacierconn, vault)
+                try:
+                    stored_parts = gv.list_all_parts(journal.header['upload_id'])
+                except glaciercorecalls.GlacierError, e:
+                    if e.status != 404:
+                        raise
+                    # Aborted, or expired: Glacier forgets uploads after a while.
+                    print "Upload %s no longer exists, starting a new one." % (
+                            journal.header['upload_id'],)
+                    journal.remove()
+                    journal = None
+            if journal:
+                upload_id = journal.header['upload_id']
+                part_size = journal.header['part_size'] / 1024 / 1024
+                done_parts = journal.verified_parts(stored_parts)
+                print "Resuming upload %s, %d parts already stored." % (upload_id,
+                                                                        len(done_parts))
+            # Read whole parts at a time so stored parts can be skipped.
+            read_size = min(READ_PART_SIZE, part_size*1024*1024)
 
         writer = glaciercorecalls.GlacierWriter(glacierconn, vault, description=description,
-                                                part_size=(part_size*1024*1024))
-
-        #Read file in chunks so we don't fill whole memory
+                                                part_size=(part_size*1024*1024),
+                                                concurrency=concurrency,
+                                                upload_id=upload_id,
+                                                journal=journal,
+                                                hash_workers=args.hash_workers)
+        if args.resume and not journal:
+            journal_header['part_size'] = writer.part_size
+            writer.journal = glaciercorecalls.UploadJournal.start(
+                JOURNAL_DIR, writer.upload_id, **journal_header)
+
+        # Regular files are memory-mapped and sent part by part straight
+        # from the mapping. Fall back to reading if the file can't be mapped
+        # (empty files, or too big for the address space).
+        mapping = None
+        if not stdin and total_size > 0:
+            try:
+                mapping = mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError, OverflowError):
+                mapping = None
+
+        def mapped_parts():
+            for offset in xrange(0, total_size, writer.part_size):
+                size = min(writer.part_size, total_size - offset)
+                if offset in done_parts:
+                    writer.skip_part(*done_parts[offset])
+                else:
+                    writer.write_mapped(mapping, offset, size)
+                yield size
+
+        def read_part():
+            # Skip parts that are already stored, then read the next chunk.
+            offset = reader.tell()
+            while offset in done_parts:
+                size, part_tree_hash = done_parts[offset]
+                writer.skip_part(size, part_tree_hash)
+                offset += size
+                reader.seek(offset)
+            return writer.write_from(reader, read_size)
+
+        #Read file in chunks, straight into the writer's part buffer, so we
+        #don't fill whole memory
         start_time = current_time = previous_time = time.time()
-        for part in iter((lambda:reader.read(READ_PART_SIZE)), ''):
-
-            writer.write(part)
+        if mapping:
+            counts = mapped_parts()
+        elif done_parts:
+            counts = iter(read_part, 0)
+        else:
+            counts = iter(lambda:writer.write_from(reader, read_size), 0)
+        for count in counts:
+            if tuner:
+                tuner.update(writer)
 
             if total_size > 0:
                 # Calculate transfer rates in bytes per second.
                 current_time = time.time()
-                current_rate = int(READ_PART_SIZE/(current_time - previous_time))
+                current_rate = int(count/(current_time - previous_time))
                 overall_rate = int(writer.uploaded_size/(current_time - start_time))
 
                 # Estimate finish time, based on overall transfer rate.
@@ -353,6 +889,10 @@ def putarchive(args):
             previous_time = current_time
 
         writer.close()
+        if mapping:
+            mapping.close()
+        if writer.journal:
+            writer.journal.remove()
         current_time = time.time()
         if total_size > 0:
             progress('\rWrote %s of %s bytes (%s%%). Transfer rate %s.\n' %
@@ -368,58 +908,352 @@ def putarchive(args):
         archive_id = writer.get_archive_id()
         location = writer.get_location()
         sha256hash = writer.get_hash()
-        if BOOKKEEPING:
-            file_attrs = {
-                'region':region,
-                'vault':vault,
-                'filename':filename,
-                'archive_id': archive_id,
-                'location':location,
-                'description':description,
-                'date':'%s' % datetime.datetime.utcnow().replace(tzinfo=pytz.utc),
-                'hash':sha256hash
-            }
-
-            if args.name:
-                file_attrs['filename'] = args.name
-            elif stdin:
-                file_attrs['filename'] = description
-
-            domain.put_attributes(file_attrs['filename'], file_attrs)
+        file_attrs = {
+            'region':region,
+            'vault':vault,
+            'filename':filename,
+            'archive_id': archive_id,
+            'location':location,
+            'description':description,
+            'date':'%s' % datetime.datetime.utcnow().replace(tzinfo=pytz.utc),
+            'hash':sha256hash,
+            'size':writer.uploaded_size
+        }
+
+        if args.name:
+            file_attrs['filename'] = args.name
+        elif stdin:
+            file_attrs['filename'] = description
 
         print "Created archive with ID: ", archive_id
         print "Archive SHA256 tree hash: ", sha256hash
 
+        # The archive exists now, so a catalog problem mustn't hide its ID.
+        try:
+            catalog.add_archive(**file_attrs)
+        except sqlite3.Error, e:
+            print >> sys.stderr, "Warning: couldn't record the archive in the catalog: %s" % (e,)
+        if tuner:
+            catalog.set_transfer_stats(region, **tuner.measured(writer))
+            print "Used up to %d connections; best throughput with %d." % (
+                    tuner.peak_concurrency, tuner.best_concurrency)
+        if BOOKKEEPING:
+            catalog.sync_simpledb(domain.get(), pull=False)
+
+def treehash(args):
+    for filename in args.filename:
+        tree_hash = glaciercorecalls.file_tree_hash(filename, workers=args.hash_workers)
+        print "%s  %s" % (glaciercorecalls.bytes_to_hex(tree_hash), filename)
+
+def find_job(catalog, gv, region, archive_id):
+    """
+    The retrieval job of an archive, with its status, or None if there is
+    none that didn't fail. The job is looked up in the local job cache
+    first; only if it isn't there, or Glacier has forgotten it, are the
+    vault's jobs listed. A job found that way is added to the cache.
+    """
+    cached = catalog.get_job(region, gv.name, archive_id)
+    if cached:
+        job = gv.get_job(cached['job_id'])
+        try:
+            if job.job_status().status_code != "Failed":
+                return job
+        except glaciercorecalls.GlacierError, e:
+            if e.status != 404:
+                raise
+        catalog.delete_job(cached['job_id'])
+    for description in gv.iter_jobs():
+        if description['ArchiveId'] == archive_id and description['StatusCode'] != "Failed":
+            job = gv.get_job(description['JobId']).update(description)
+            catalog.add_job(region, gv.name, archive_id, job.job_id, job.created)
+            return job
+    return None
+
+def write_job_output(job, filename, concurrency=1, resume=False):
+    """
+    Download the output of a completed job into filename, or to stdout.
+    """
+    if filename and (concurrency > 1 or resume):
+        job.download_output(filename, concurrency, resume=resume)
+    elif filename:
+        with open(filename, "wb") as ffile:
+            job.write_output(ffile)
+    else:
+        job.write_output(sys.stdout)
+
+def fetch_archive(args, catalog, gv, archive_id, out_file):
+    """
+    Download an archive into out_file (or to stdout) if its retrieval job
+    is done. Otherwise a job is started unless one is running, and with
+    --wait it is polled until it completes. A job left running is cached
+    with out_file, so `watch` can download it later; other files already
+    waiting for the same job are kept.
+    """
+    # Keep stdout clean when the archive itself goes there.
+    messages = sys.stdout if out_file else sys.stderr
+    job = find_job(catalog, gv, args.region, archive_id)
+    if job is None:
+        job = gv.retrieve_archive(archive_id)
+        job.completed = False
+        catalog.add_job(args.region, gv.name, archive_id, job.job_id,
+                        datetime.datetime.utcnow().isoformat())
+        print >> messages, "Started retrieval of archive", archive_id
+    if not job.completed:
+        if out_file:
+            catalog.add_job_output(job.job_id, os.path.abspath(out_file))
+        if not args.wait:
+            print >> messages, "Waiting for Amazon Glacier to assamble the archive."
+            return True
+        print >> messages, "Waiting for job %s to complete." % (job.job_id,)
+        watcher = glaciercorecalls.JobWatcher(min_interval=args.poll_interval)
+        watcher.add(job, delay=args.poll_interval)
+        job = next(iter(watcher))
+    if job.status_code != "Succeeded":
+        catalog.delete_job(job.job_id)
+        raise Exception(u"Retrieval of archive %s failed: %s"
+                        % (archive_id, job.status_msg if job.status_code else "job expired"))
+    write_job_output(job, out_file, args.concurrency, args.resume)
+    if out_file:
+        catalog.remove_job_output(job.job_id, os.path.abspath(out_file))
+    return True
+
 def getarchive(args):
+    glacierconn = connect(args, args.region)
+    gv = glaciercorecalls.GlacierVault(glacierconn, args.vault)
+    catalog = glaciercatalog.GlacierCatalog(args.catalog)
+    return fetch_archive(args, catalog, gv, args.archive, args.filename)
+
+def download_job(catalog, job, out_file, concurrency=1):
+    """
+    Download the output of a completed job into out_file, resuming an
+    earlier partial download, and mark it done in the job cache. Returns
+    whether it worked, for use in a pool of download threads.
+    """
+    try:
+        directory = os.path.dirname(out_file)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another download may have just created it.
+                if not os.path.isdir(directory):
+                    raise
+        write_job_output(job, out_file, concurrency, resume=True)
+    except Exception, e:
+        print "Failed to download %s: %s" % (out_file, e)
+        return False
+    catalog.remove_job_output(job.job_id, out_file)
+    print "Downloaded", out_file
+    return True
+
+def watch(args):
+    """
+    Wait for the retrieval jobs whose output is wanted in a file, as left
+    by getarchive and download without --wait, and download each one as
+    soon as it completes while the others are still being polled.
+    """
+    catalog = glaciercatalog.GlacierCatalog(args.catalog)
+    waiting = catalog.waiting_jobs(args.region, args.vault)
+    if not waiting:
+        print "No jobs to wait for."
+        return True
+
+    glacierconn = connect(args, args.region)
+    glacierconn.connection_pool.reserve(args.download_workers * args.concurrency)
+    vaults = {}
+    cached_jobs = {}
+    watcher = glaciercorecalls.JobWatcher(min_interval=args.poll_interval)
+    for cached in waiting:
+        if cached['job_id'] in cached_jobs:
+            # The same archive is wanted in another file as well.
+            cached_jobs[cached['job_id']].append(cached)
+            continue
+        if cached['vault'] not in vaults:
+            vaults[cached['vault']] = glaciercorecalls.GlacierVault(glacierconn, cached['vault'])
+        job = vaults[cached['vault']].get_job(cached['job_id'])
+        cached_jobs[job.job_id] = [cached]
+        watcher.add(job)
+
+    print "Waiting for %d jobs." % (len(watcher),)
+    pool = ThreadPool(args.download_workers)
+    results = []
+    for job in watcher:
+        for cached in cached_jobs[job.job_id]:
+            out_file = glaciercatalog.to_bytes(cached['out_file'])
+            if job.status_code == "Succeeded":
+                results.append(pool.apply_async(download_job, (catalog, job, out_file,
+                                                               args.concurrency)))
+            else:
+                print "Retrieval of archive %s for %s %s." % (
+                        cached['archive_id'], out_file,
+                        "failed" if job.status_code else "expired")
+        if job.status_code != "Succeeded":
+            catalog.delete_job(job.job_id)
+    pool.close()
+    pool.join()
+    failed = len(waiting) - sum(result.get() for result in results)
+    print "Downloaded %d of %d archives in %d polls." % (
+            len(waiting) - failed, len(waiting), watcher.polls)
+    return not failed
+
+def restore_path(directory, archive):
+    """
+    Where in directory to restore an archive: under its original path if
+    the catalog knows it, otherwise under its description or ID. Names
+    that would lead outside directory fall back to the archive ID.
+    """
+    name = archive.get('filename') or archive.get('description') or archive['archive_id']
+    name = glaciercatalog.to_bytes(name)
+    path = os.path.normpath(os.path.join(directory, name.lstrip("/\\")))
+    if not path.startswith(directory + os.sep):
+        path = os.path.join(directory, archive['archive_id'])
+    return path
+
+def restore(args):
+    """
+    Restore many archives into a directory tree. Retrieval jobs are started
+    as the RetrievalPlanner allows, all of them are polled on one schedule,
+    and each archive is downloaded as soon as its job completes, several
+    at a time. Jobs are kept in the job cache, so running the command again
+    after an interruption carries on with the jobs already started, and
+    archives already restored are skipped.
+    """
     region = args.region
     vault = args.vault
-    archive = args.archive
-    filename = args.filename
+    directory = os.path.abspath(args.directory)
+    catalog = glaciercatalog.GlacierCatalog(args.catalog)
+
+    archive_ids = list(args.archive)
+    if args.archive_list:
+        fo = sys.stdin if args.archive_list == '-' else open(args.archive_list)
+        archive_ids += [line.strip() for line in fo if line.strip()]
+    archives = []
+    if args.search is not None:
+        archives += catalog.search(region, vault, args.search)
+    archives += [catalog.get_archive(archive_id) or {'archive_id': archive_id}
+                 for archive_id in archive_ids]
+    seen = set()
+    todo = []
+    for archive in archives:
+        if archive['archive_id'] in seen:
+            continue
+        seen.add(archive['archive_id'])
+        archive['out_file'] = restore_path(directory, archive)
+        out_file = archive['out_file']
+        if (os.path.exists(out_file) and
+            not os.path.exists(out_file + glaciercorecalls.GlacierJob.JOURNAL_SUFFIX) and
+            archive.get('size') in (None, os.path.getsize(out_file))):
+            continue
+        todo.append(archive)
+    if not todo:
+        print "Nothing to restore, %d archives are already in %s." % (len(seen), directory)
+        return True
 
-    glacierconn = glaciercorecalls.GlacierConnection(args.aws_access_key, args.aws_secret_key, region=region)
+    glacierconn = connect(args, region)
+    glacierconn.connection_pool.reserve(args.download_workers * args.concurrency)
     gv = glaciercorecalls.GlacierVault(glacierconn, vault)
+    watcher = glaciercorecalls.JobWatcher(min_interval=args.poll_interval)
+    jobs = {}
+    to_start = []
+    for archive in todo:
+        cached = catalog.get_job(region, vault, archive['archive_id'])
+        if cached:
+            job = gv.get_job(cached['job_id'])
+            catalog.add_job_output(job.job_id, archive['out_file'])
+            jobs[job.job_id] = archive
+            watcher.add(job)
+        else:
+            to_start.append(archive)
+
+    planner = glaciercorecalls.RetrievalPlanner(
+        max_rate=args.max_rate and int(args.max_rate * 1024**3),
+        max_jobs=args.jobs_per_hour)
+    plan = collections.deque(planner.plan(to_start))
+    total_size = sum(archive.get('size') or 0 for archive in todo)
+    hours = (plan[-1][0] - time.time()) / 3600 if plan else 0
+    print "Restoring %d archives (%s) into %s: %d jobs already started, %d to start %s." % (
+            len(todo), size_fmt(total_size), directory, len(jobs), len(plan),
+            "over %.1f hours" % (hours,) if hours >= 0.1 else "now")
+    unknown = sum(1 for archive in todo if archive.get('size') is None)
+    if unknown and args.max_rate:
+        print "The size of %d archives isn't in the catalog, so they don't count " \
+              "towards --max-rate. Run inventory to record it." % (unknown,)
+    if args.dry_run:
+        for start, archive in plan:
+            print "%s\t%s\t%s" % (time.strftime("%Y-%m-%d %H:%M", time.localtime(start)),
+                                  archive['archive_id'], archive['out_file'])
+        return True
 
-    jobs = gv.list_jobs()
-    found = False
-    for job in gv.job_list:
-        if job['ArchiveId'] == archive:
-            found = True
-            # no need to start another archive retrieval
-            if filename or not job['Completed']:
-                print "ArchiveId: ", archive
-            if job['Completed']:
-                job2 = glaciercorecalls.GlacierJob(gv, job_id=job['JobId'])
-                if filename:
-                    ffile = open(filename, "w")
-                    for part in iter((lambda:job2.get_output().read(READ_PART_SIZE)), ''):
-                        ffile.write(part)
-                    ffile.close()
-                else:
-                    print job2.get_output().read()
-                return
-    if not found:
-        job = gv.retrieve_archive(archive)
-        print "Started"
+    pool = ThreadPool(args.download_workers)
+    results = []
+    failed = 0
+    while plan or len(watcher):
+        now = time.time()
+        while plan and plan[0][0] <= now:
+            start, archive = plan.popleft()
+            job = gv.retrieve_archive(archive['archive_id'])
+            catalog.add_job(region, vault, archive['archive_id'], job.job_id,
+                            datetime.datetime.utcnow().isoformat(), archive['out_file'])
+            jobs[job.job_id] = archive
+            watcher.add(job, delay=args.poll_interval)
+        for job in watcher.poll():
+            archive = jobs.pop(job.job_id)
+            if job.status_code == "Succeeded":
+                results.append(pool.apply_async(download_job, (catalog, job, archive['out_file'],
+                                                               args.concurrency)))
+                continue
+            catalog.delete_job(job.job_id)
+            if job.status_code is None:
+                # The job expired before it was downloaded, start it again
+                # when --max-rate and --jobs-per-hour allow.
+                plan.extend(planner.plan([archive]))
+            else:
+                print "Retrieval of %s failed: %s" % (archive['out_file'], job.status_msg)
+                failed += 1
+        waits = [t for t in (plan and plan[0][0], watcher.next_poll()) if t]
+        if waits:
+            time.sleep(max(0, min(waits) - time.time()))
+    pool.close()
+    pool.join()
+    failed += sum(1 for result in results if not result.get())
+    print "Restored %d of %d archives into %s in %d polls." % (
+            len(todo) - failed, len(todo), directory, watcher.polls)
+    return not failed
+
+def download_member(args, member):
+    """
+    Fetch a single file out of a pack archive with a ranged request for
+    its bytes of the pack's retrieval job output, and check it against
+    the tree hash recorded when it was packed.
+    """
+    glacierconn = connect(args, args.region)
+    gv = glaciercorecalls.GlacierVault(glacierconn, member['vault'])
+    catalog = glaciercatalog.GlacierCatalog(args.catalog)
+
+    job = find_job(catalog, gv, args.region, member['archive_id'])
+    if job is None:
+        job = gv.retrieve_archive(member['archive_id'])
+        catalog.add_job(args.region, gv.name, member['archive_id'], job.job_id,
+                        datetime.datetime.utcnow().isoformat())
+        print "Started retrieval of pack archive", member['archive_id']
+        return True
+    if not job.completed:
+        print "Waiting for Amazon Glacier to assamble the pack archive."
+        return True
+    if job.status_code != "Succeeded":
+        catalog.delete_job(job.job_id)
+        raise Exception(u"Retrieval of pack archive %s failed: %s"
+                        % (member['archive_id'], job.status_msg))
+    out = open(args.out_file, "wb") if args.out_file else sys.stdout
+    try:
+        member_hash = job.write_output_range(out, member['offset'], member['size'])
+    finally:
+        if args.out_file:
+            out.close()
+    if member_hash != member['hash']:
+        raise Exception(u"Tree hash mismatch for %s: expected %s, got %s"
+                        % (member['filename'], member['hash'], member_hash))
+    return True
 
 def download(args):
     region = args.region
@@ -436,6 +1270,17 @@ def download(args):
 
     n_items = 0
     if not items:
+        catalog = glaciercatalog.GlacierCatalog(args.catalog)
+        members = catalog.search_members(region, vault, filename)
+        if len(members) == 1:
+            return download_member(args, members[0])
+        elif members:
+            print "Region\tVault\tFilename\tPack archive ID"
+            for member in members:
+                print "\t".join(glaciercatalog.to_bytes(member[key]) for key in
+                                ('region', 'vault', 'filename', 'archive_id'))
+            print "You need to uniquely identify the file."
+            return False
         print "Sorry, didn't find anything."
         return False
 
@@ -444,10 +1289,8 @@ def download(args):
         n_items += 1
         archive = item['archive_id']
         vault = item['vault']
-        print "%s\t%s\t%s\t%s" % (item['region'],
-                                  item['vault'],
-                                  item['filename'],
-                                  item['archive_id'])
+        print "\t".join(glaciercatalog.to_bytes(item[key]) for key in
+                        ('region', 'vault', 'filename', 'archive_id'))
 
     if n_items > 1:
         print "You need to uniquely identify file with either region, vault or \
@@ -455,29 +1298,10 @@ def download(args):
                specify exactly which archive you want."
         return False
 
-    glacierconn = glaciercorecalls.GlacierConnection(args.aws_access_key, args.aws_secret_key, region=region)
+    glacierconn = connect(args, region)
     gv = glaciercorecalls.GlacierVault(glacierconn, vault)
-
-    jobs = gv.list_jobs()
-    found = False
-    for job in gv.job_list:
-        if job['ArchiveId'] == archive:
-            found = True
-            # no need to start another archive retrieval
-            if not job['Completed']:
-                print "Waiting for Amazon Glacier to assamble the archive."
-            if job['Completed']:
-                job2 = glaciercorecalls.GlacierJob(gv, job_id=job['JobId'])
-                if out_file:
-                    ffile = open(out_file, "w")
-                    ffile.write(job2.get_output().read())
-                    ffile.close()
-                else:
-                    print job2.get_output().read()
-            return True
-    if not found:
-        job = gv.retrieve_archive(archive)
-        print "Started"
+    catalog = glaciercatalog.GlacierCatalog(args.catalog)
+    return fetch_archive(args, catalog, gv, archive, out_file)
 
 def deletearchive(args):
     region = args.region
@@ -486,65 +1310,35 @@ def deletearchive(args):
     BOOKKEEPING= args.bookkeeping
     BOOKKEEPING_DOMAIN_NAME= args.bookkeeping_domain_name
 
-    if BOOKKEEPING:
-        sdb_conn = boto.connect_sdb(aws_access_key_id=args.aws_access_key,
-                                    aws_secret_access_key=args.aws_secret_key)
-        domain_name = BOOKKEEPING_DOMAIN_NAME
-        try:
-            domain = sdb_conn.get_domain(domain_name, validate=True)
-        except boto.exception.SDBResponseError:
-            domain = sdb_conn.create_domain(domain_name)
-
-    glacierconn = glaciercorecalls.GlacierConnection(args.aws_access_key, args.aws_secret_key, region=region)
+    glacierconn = connect(args, region)
     gv = glaciercorecalls.GlacierVault(glacierconn, vault)
 
     parse_response( gv.delete_archive(archive) )
 
-    # TODO: can't find a method for counting right now
-    query = 'select * from `%s` where archive_id="%s"' % (BOOKKEEPING_DOMAIN_NAME, archive)
-    items = domain.select(query)
-    for item in items:
-        domain.delete_item(item)
+    glaciercatalog.GlacierCatalog(args.catalog).delete_archive(archive)
+
+    if BOOKKEEPING:
+        domain = get_bookkeeping_domain(args)
+        # TODO: can't find a method for counting right now
+        query = 'select * from `%s` where archive_id="%s"' % (BOOKKEEPING_DOMAIN_NAME, archive)
+        items = domain.select(query)
+        for item in items:
+            domain.delete_item(item)
 
 def search(args, print_results=True):
     region = args.region
     vault = args.vault
     search_term = args.search_term
-    BOOKKEEPING= args.bookkeeping
-    BOOKKEEPING_DOMAIN_NAME= args.bookkeeping_domain_name
 
-    if BOOKKEEPING:
-        sdb_conn = boto.connect_sdb(aws_access_key_id=args.aws_access_key,
-                                    aws_secret_access_key=args.aws_secret_key)
-        domain_name = BOOKKEEPING_DOMAIN_NAME
-        try:
-            domain = sdb_conn.get_domain(domain_name, validate=True)
-        except boto.exception.SDBResponseError:
-            domain = sdb_conn.create_domain(domain_name)
-    else:
-        raise Exception(u"You have to enable bookkeeping in your settings \
-                          before you can perform search.")
-
-    search_params = []
     table_title = ""
-    if region:
-        search_params += ["region='%s'" % (region,)]
-    else:
+    if not region:
         table_title += "Region\t"
-
-    if vault:
-        search_params += ["vault='%s'" % (vault,)]
-    else:
+    if not vault:
         table_title += "Vault\t"
-
     table_title += "Filename\tArchive ID"
 
-    if search_term:
-        search_params += ["(filename like '"+ search_term+"%' or description like '"+search_term+"%')" ]
-    search_params = " and ".join(search_params)
-
-    query = 'select * from `%s` where %s' % (BOOKKEEPING_DOMAIN_NAME, search_params)
-    items = domain.select(query)
+    catalog = glaciercatalog.GlacierCatalog(args.catalog)
+    items = catalog.search(region=region, vault=vault, search_term=search_term)
 
     if print_results:
         print table_title
@@ -559,23 +1353,78 @@ def search(args, print_results=True):
         item_attrs += [item[u'filename']]
         item_attrs += [item[u'archive_id']]
         if print_results:
-            print "\t".join(item_attrs)
+            print "\t".join(glaciercatalog.to_bytes(attr) for attr in item_attrs)
 
     if not print_results:
         return items
 
-def render_inventory(inventory):
-    print "Inventory of vault: %s" % (inventory["VaultARN"],)
-    print "Inventory Date: %s\n" % (inventory['InventoryDate'],)
-    print "Content:"
-    table = PrettyTable(["Archive Description", "Uploaded", "Size", "Archive ID", "SHA256 hash"])
-    for archive in inventory['ArchiveList']:
-        table.add_row([archive['ArchiveDescription'],
-                       archive['CreationDate'],
-                       locale.format('%d', archive['Size'], grouping=True),
-                       archive['ArchiveId'],
-                       archive['SHA256TreeHash']])
-    print table
+def sync(args):
+    if not args.bookkeeping_domain_name:
+        raise Exception(u"You have to set bookkeeping-domain-name in your \
+                          settings before you can sync with SimpleDB.")
+    catalog = glaciercatalog.GlacierCatalog(args.catalog)
+    pushed, pulled = catalog.sync_simpledb(get_bookkeeping_domain(args))
+    print "Pushed %d and pulled %d archives." % (pushed, pulled)
+
+INVENTORY_KEYS = ['ArchiveId', 'ArchiveDescription', 'CreationDate', 'Size', 'SHA256TreeHash']
+
+def render_inventory(header, archives, output="table"):
+    """
+    Print the archives of an inventory, yielding each one again so they
+    can be stored while they are printed. The csv and jsonl formats print
+    every archive as soon as it is read; the table has to collect them all
+    first. header is only read once archives is exhausted.
+    """
+    if output == "csv":
+        writer = csv.writer(sys.stdout)
+        writer.writerow(INVENTORY_KEYS)
+        for archive in archives:
+            writer.writerow([unicode(archive[key]).encode('utf-8') for key in INVENTORY_KEYS])
+            yield archive
+    elif output == "jsonl":
+        for archive in archives:
+            print json.dumps(archive)
+            yield archive
+    else:
+        table = PrettyTable(["Archive Description", "Uploaded", "Size", "Archive ID", "SHA256 hash"])
+        for archive in archives:
+            table.add_row([archive['ArchiveDescription'],
+                           archive['CreationDate'],
+                           locale.format('%d', archive['Size'], grouping=True),
+                           archive['ArchiveId'],
+                           archive['SHA256TreeHash']])
+            yield archive
+        print "Inventory of vault: %s" % (header["VaultARN"],)
+        print "Inventory Date: %s\n" % (header['InventoryDate'],)
+        print "Content:"
+        print table
+
+def inventory_diff(args):
+    region = args.region
+    vault = args.vault
+
+    catalog = glaciercatalog.GlacierCatalog(args.catalog)
+    # Newest first; by default compare the latest with the one before it.
+    dates = [date for date, job_id in catalog.list_inventories(region, vault)]
+    new_date = args.to_date or (dates[0] if dates else None)
+    older = [date for date in dates if new_date and date < new_date]
+    old_date = args.from_date or (older[0] if older else None)
+    if not old_date or not new_date:
+        print "Need two inventories of %s to compare, have %d." % (vault, len(dates))
+        return False
+
+    added, removed = catalog.diff_inventories(region, vault, old_date, new_date)
+    print "Changes in vault %s from %s to %s:" % (vault, old_date, new_date)
+    counts = []
+    for sign, archives in (("+", added), ("-", removed)):
+        count = 0
+        for archive in archives:
+            print "%s\t%s\t%s\t%s\t%s" % (sign, archive['ArchiveId'],
+                                         archive['ArchiveDescription'],
+                                         archive['Size'], archive['CreationDate'])
+            count += 1
+        counts.append(count)
+    print "%d archives added, %d removed." % tuple(counts)
 
 def inventory(args):
     region = args.region
@@ -584,50 +1433,81 @@ def inventory(args):
     BOOKKEEPING= args.bookkeeping
     BOOKKEEPING_DOMAIN_NAME= args.bookkeeping_domain_name
 
-    glacierconn = glaciercorecalls.GlacierConnection(args.aws_access_key, args.aws_secret_key, region=region)
+    if args.diff or args.from_date or args.to_date:
+        return inventory_diff(args)
+
+    glacierconn = connect(args, region)
     gv = glaciercorecalls.GlacierVault(glacierconn, vault)
     if force:
         job = gv.retrieve_inventory(format="JSON")
         return True
     try:
-        gv.list_jobs()
         inventory_retrievals_done = []
-        for job in gv.job_list:
-            if job['Action'] == "InventoryRetrieval" and job['StatusCode'] == "Succeeded":
+        for job in gv.iter_jobs(status_code="Succeeded"):
+            if job['Action'] == "InventoryRetrieval":
                 d = dateutil.parser.parse(job['CompletionDate']).replace(tzinfo=pytz.utc)
                 job['inventory_date'] = d
                 inventory_retrievals_done += [job]
 
+        if not inventory_retrievals_done and args.wait:
+            running = [job for job in gv.iter_jobs(completed=False)
+                       if job['Action'] == "InventoryRetrieval"]
+            if running:
+                job = gv.get_job(running[0]['JobId'])
+            else:
+                job = gv.retrieve_inventory(format="JSON")
+            print >> sys.stderr, "Waiting for inventory job %s to complete." % (job.job_id,)
+            watcher = glaciercorecalls.JobWatcher(min_interval=args.poll_interval)
+            watcher.add(job, delay=args.poll_interval)
+            job = next(iter(watcher))
+            if job.status_code == "Succeeded":
+                job.json_output['inventory_date'] = dateutil.parser.parse(
+                    job.json_output['CompletionDate']).replace(tzinfo=pytz.utc)
+                inventory_retrievals_done = [job.json_output]
+
         if len(inventory_retrievals_done):
             list.sort(inventory_retrievals_done,
                       key=lambda i: i['inventory_date'], reverse=True)
             job = inventory_retrievals_done[0]
-            print "Inventory with JobId:", job['JobId']
-            job = glaciercorecalls.GlacierJob(gv, job_id=job['JobId'])
-            inventory = json.loads(job.get_output().read())
-
-            if BOOKKEEPING:
-                sdb_conn = boto.connect_sdb(aws_access_key_id=args.aws_access_key,
-                                            aws_secret_access_key=args.aws_secret_key)
-                domain_name = BOOKKEEPING_DOMAIN_NAME
-                try:
-                    domain = sdb_conn.get_domain(domain_name, validate=True)
-                except boto.exception.SDBResponseError:
-                    domain = sdb_conn.create_domain(domain_name)
-
+            if args.output == "table":
+                print "Inventory with JobId:", job['JobId']
+            catalog = glaciercatalog.GlacierCatalog(args.catalog)
+            inventory = catalog.get_inventory(region, vault, job_id=job['JobId'])
+            if inventory is not None:
+                # Already downloaded this one, no need to fetch it again.
+                for archive in render_inventory(inventory, inventory['ArchiveList'], args.output):
+                    pass
                 d = dateutil.parser.parse(inventory['InventoryDate']).replace(tzinfo=pytz.utc)
-                item = domain.put_attributes("%s" % (d,), inventory)
+            else:
+                job_id = job['JobId']
+                job = glaciercorecalls.GlacierJob(gv, job_id=job_id)
+                reader = glaciercorecalls.InventoryReader(job.get_output())
+                catalog.add_inventory(region, vault, job_id, reader.header,
+                                      render_inventory(reader.header, reader, args.output))
+
+                d = dateutil.parser.parse(reader.header['InventoryDate']).replace(tzinfo=pytz.utc)
+                if BOOKKEEPING:
+                    domain = get_bookkeeping_domain(args)
+                    item = domain.put_attributes("%s" % (d,), reader.header)
 
             if ((datetime.datetime.utcnow().replace(tzinfo=pytz.utc) - d).days > 1):
                 gv.retrieve_inventory(format="JSON")
-
-            render_inventory(inventory)
         else:
             job = gv.retrieve_inventory(format="JSON")
     except Exception, e:
         print "exception: ", e
         print json.loads(e[1])['message']
 
+def add_wait_arguments(parser):
+    parser.add_argument('--wait', action='store_true',
+            help="If the retrieval job isn't done yet, wait for it instead of \
+                  exiting, then download the output.")
+    parser.add_argument('--poll-interval', type=int,
+            default=glaciercorecalls.JobWatcher.MIN_INTERVAL,
+            help="Seconds between the first polls of the job when waiting. \
+                  Polls back off to once every %d minutes."
+                  % (glaciercorecalls.JobWatcher.MAX_INTERVAL / 60,))
+
 def main():
     program_description = u"""
     Command line interface for Amazon Glacier
@@ -702,6 +1582,20 @@ def main():
                         required= False,
                         default= default("bookkeeping-domain-name"),
                         help="SimpleDB domain name for bookkeeping.")
+    group.add_argument('--catalog',
+                        required= False,
+                        default= default("catalog") or CATALOG,
+                        help="Local SQLite catalog of uploaded archives, used by \
+                              search and download.")
+    group.add_argument('--endpoint',
+                        required= False,
+                        default= default("endpoint"),
+                        help="URL of the Glacier endpoint to use instead of the \
+                              region's, e.g. http://localhost:8080 for a local \
+                              test server.")
+    group.add_argument('--connection-stats', action='store_true',
+                        help="Print how many HTTP connections were opened and reused, \
+                              and how many requests had to be retried.")
 
     parser_lsvault = subparsers.add_parser("lsvault", help="List vaults")
     parser_lsvault.set_defaults(func=lsvault)
@@ -715,6 +1609,10 @@ def main():
     parser_rmvault.set_defaults(func=rmvault)
 
     parser_listjobs = subparsers.add_parser('listjobs', help='List jobs')
+    parser_listjobs.add_argument('--status', choices=['InProgress', 'Succeeded', 'Failed'],
+                                 help="Only list jobs with this status.")
+    parser_listjobs.add_argument('--page-size', type=int, default=None,
+                                 help="Jobs fetched per request, at most 1000 (the default).")
     parser_listjobs.add_argument('vault')
     parser_listjobs.set_defaults(func=listjobs)
 
@@ -726,7 +1624,7 @@ def main():
     parser_upload = subparsers.add_parser('upload', help='Upload an archive',
                                formatter_class=argparse.RawTextHelpFormatter)
     parser_upload.add_argument('vault')
-    parser_upload.add_argument('filename')
+    parser_upload.add_argument('filename', nargs='?')
     parser_upload.add_argument('--stdin',
                                 help="Input data from stdin, instead of file",
                                 action='store_true')
@@ -762,32 +1660,163 @@ By default, the smallest possible value is used
 when the archive size is known ahead of time.
 Otherwise (when reading from STDIN) a value of
 128 is used.''')
+    parser_upload.add_argument('--concurrency', type=int, default=1,
+                               help='''\
+Number of parts to upload at the same time, each
+over its own connection. At most this many parts
+are kept in memory, so memory use is roughly
+concurrency * partsize.''')
+    parser_upload.add_argument('--auto-tune', action='store_true',
+            help="Pick the part size and number of connections from the \
+                  throughput measured in earlier uploads, and add connections \
+                  while that speeds up the upload.")
+    parser_upload.add_argument('--max-memory', type=int, default=512,
+            help="With --auto-tune, memory in MB the part buffers may use.")
+    parser_upload.add_argument('--resume', action='store_true',
+                               help='''\
+Keep a journal of the stored parts in %s.
+If an earlier upload of the same file was
+interrupted, continue it and only upload the
+parts Glacier doesn't have yet.''' % (JOURNAL_DIR,))
+    parser_upload.add_argument('--hash-workers', type=int, default=HASH_WORKERS,
+                               help='''\
+Number of threads used to compute the SHA256 tree
+hashes. Defaults to the number of CPUs.''')
+    parser_upload.add_argument('--batch', action='store_true',
+            help="Upload every file given (and every file in the directories \
+                  given) as its own archive, from one process. Positional \
+                  arguments after the vault are all taken as paths.")
+    parser_upload.add_argument('--manifest', metavar='FILE',
+            help="Upload the files listed in FILE (one path per line, - for \
+                  stdin) as a batch.")
+    parser_upload.add_argument('--pack', action='store_true',
+            help="Like --batch, but stream all the files into a single archive \
+                  (named --name). Where each file is in it is kept in the \
+                  catalog, so download can fetch single files.")
+    parser_upload.add_argument('--dedup', action='store_true',
+            help="Compute the tree hash of each file first and skip the upload \
+                  if an archive with the same content is already in the vault \
+                  (as far as the catalog knows from uploads, inventories and \
+                  SimpleDB).")
+    parser_upload.add_argument('--incremental', action='store_true',
+            help="Only upload the 1MB chunks of the file that changed since \
+                  the last incremental upload of it, as a delta archive. Use \
+                  rebuild to get the whole file back.")
+    parser_upload.add_argument('--batch-workers', type=int, default=4,
+            help="Number of files uploaded at the same time in a batch.")
     parser_upload.add_argument('description', nargs='*')
     parser_upload.set_defaults(func=putarchive)
 
+    parser_treehash = subparsers.add_parser('treehash',
+                help='Print the SHA256 tree hash of local files')
+    parser_treehash.add_argument('--hash-workers', type=int, default=HASH_WORKERS,
+                                 help="Number of threads used for hashing.")
+    parser_treehash.add_argument('filename', nargs='+')
+    parser_treehash.set_defaults(func=treehash)
+
+    parser_rebuild = subparsers.add_parser('rebuild',
+                help='Rebuild a file uploaded with upload --incremental')
+    parser_rebuild.add_argument('--version', type=int, default=None,
+                                help="Version to rebuild, the latest by default.")
+    parser_rebuild.add_argument('vault')
+    parser_rebuild.add_argument('filename')
+    parser_rebuild.add_argument('out_file', nargs='?',
+                                help="Where to write the file, by default its name \
+                                      in the current directory.")
+    parser_rebuild.set_defaults(func=rebuild)
+
     parser_getarchive = subparsers.add_parser('getarchive',
                 help='Get a file by explicitly setting archive id')
     parser_getarchive.add_argument('vault')
     parser_getarchive.add_argument('archive')
     parser_getarchive.add_argument('filename', nargs='?')
+    parser_getarchive.add_argument('--concurrency', type=int, default=1,
+            help="Download the archive in this many byte ranges at the same time.")
+    parser_getarchive.add_argument('--resume', action='store_true',
+            help="Record downloaded ranges next to the file and only fetch the \
+                  missing ones if the download was interrupted.")
+    add_wait_arguments(parser_getarchive)
     parser_getarchive.set_defaults(func=getarchive)
 
+    parser_watch = subparsers.add_parser('watch',
+            help='Wait for retrieval jobs started by getarchive or download and \
+                  download each archive as soon as its job completes.')
+    parser_watch.add_argument('vault', nargs='?',
+            help="Only wait for jobs in this vault.")
+    parser_watch.add_argument('--poll-interval', type=int,
+            default=glaciercorecalls.JobWatcher.MIN_INTERVAL,
+            help="Seconds between the first polls of a job. Polls back off to \
+                  once every %d minutes." % (glaciercorecalls.JobWatcher.MAX_INTERVAL / 60,))
+    parser_watch.add_argument('--download-workers', type=int, default=2,
+            help="Number of archives downloaded at the same time.")
+    parser_watch.add_argument('--concurrency', type=int, default=1,
+            help="Download each archive in this many byte ranges at the same time.")
+    parser_watch.set_defaults(func=watch)
+
+    parser_restore = subparsers.add_parser('restore',
+            help='Restore many archives into a directory tree, starting their \
+                  retrieval jobs at a limited rate.')
+    parser_restore.add_argument('vault')
+    parser_restore.add_argument('directory',
+            help="Where to restore to. Archives go under their original path \
+                  if the catalog knows it, otherwise under their description.")
+    parser_restore.add_argument('archive', nargs='*',
+            help="IDs of the archives to restore.")
+    parser_restore.add_argument('--archive-list', metavar='FILE',
+            help="Also restore the archives whose IDs are in FILE, one per line \
+                  (- for stdin).")
+    parser_restore.add_argument('--search', metavar='SEARCH_TERM',
+            help="Also restore the archives in the catalog whose file name or \
+                  description starts with SEARCH_TERM ('' for the whole vault).")
+    parser_restore.add_argument('--max-rate', type=float, default=None,
+            help="GB of archives to start retrieving per hour. Glacier bills \
+                  retrievals by the peak hourly rate, so this bounds the cost.")
+    parser_restore.add_argument('--jobs-per-hour', type=int, default=None,
+            help="Retrieval jobs to start per hour at most.")
+    parser_restore.add_argument('--poll-interval', type=int,
+            default=glaciercorecalls.JobWatcher.MIN_INTERVAL,
+            help="Seconds between the first polls of a job.")
+    parser_restore.add_argument('--download-workers', type=int, default=4,
+            help="Number of archives downloaded at the same time.")
+    parser_restore.add_argument('--concurrency', type=int, default=1,
+            help="Download each archive in this many byte ranges at the same time.")
+    parser_restore.add_argument('--dry-run', action='store_true',
+            help="Only print when each retrieval job would be started.")
+    parser_restore.set_defaults(func=restore)
+
     parser_rmarchive = subparsers.add_parser('rmarchive', help='Remove archive')
     parser_rmarchive.add_argument('vault')
     parser_rmarchive.add_argument('archive')
     parser_rmarchive.set_defaults(func=deletearchive)
 
     parser_search = subparsers.add_parser('search',
-                help='Search SimpleDB database (if it was created). \
+                help='Search the local catalog of archives. \
                       By default returns contents of vault.')
     parser_search.add_argument('--vault')
     parser_search.add_argument('--search_term')
     parser_search.set_defaults(func=search)
 
+    parser_sync = subparsers.add_parser('sync',
+                help='Synchronise the local catalog with the SimpleDB bookkeeping domain')
+    parser_sync.set_defaults(func=sync)
+
     parser_inventory = subparsers.add_parser('inventory',
                 help='List inventory of a vault')
     parser_inventory.add_argument('--force', action='store_true',
                                  help="Create a new inventory job")
+    parser_inventory.add_argument('--output', choices=['table', 'csv', 'jsonl'], default='table',
+                                 help="Output format. csv and jsonl print each archive \
+                                       as soon as it is read, so they work for vaults of \
+                                       any size.")
+    parser_inventory.add_argument('--diff', action='store_true',
+                                 help="Show archives added and removed between two \
+                                       stored inventories, by default the two latest.")
+    parser_inventory.add_argument('--from', dest='from_date', metavar='INVENTORY_DATE',
+                                 help="Compare from this inventory date. Implies --diff.")
+    parser_inventory.add_argument('--to', dest='to_date', metavar='INVENTORY_DATE',
+                                 help="Compare up to this inventory date, instead of \
+                                       the latest. Implies --diff.")
+    add_wait_arguments(parser_inventory)
     parser_inventory.add_argument('vault')
     parser_inventory.set_defaults(func=inventory)
 
@@ -807,15 +1836,35 @@ Otherwise (when reading from STDIN) a value of
 
     # bookkeeping required
     parser_download = subparsers.add_parser('download',
-            help='Download a file by searching through SimpleDB cache for it.')
+            help='Download a file by searching through the local catalog for it.')
     parser_download.add_argument('--vault',
             help="Specify the vault in which archive is located.")
     parser_download.add_argument('--out-file')
+    parser_download.add_argument('--concurrency', type=int, default=1,
+            help="Download the archive in this many byte ranges at the same time.")
+    parser_download.add_argument('--resume', action='store_true',
+            help="Record downloaded ranges next to the file and only fetch the \
+                  missing ones if the download was interrupted.")
+    add_wait_arguments(parser_download)
     parser_download.add_argument('filename', nargs='?')
     parser_download.set_defaults(func=download)
 
     args = parser.parse_args(remaining_argv)
-    args.func(args)
+    result = args.func(args)
+
+    if args.connection_stats:
+        stats = glaciercorecalls.connection_pool.stats()
+        print >> sys.stderr, ("Connections: %(created)d opened, %(reused)d requests reused one "
+                              "(%(handshakes_avoided)d TLS handshakes avoided)." % stats)
+        retries = glaciercorecalls.retry_policy.stats()
+        print >> sys.stderr, ("Retries: %(error)d after connection errors, %(server)d after "
+                              "server errors, %(throttled)d after throttling; %(waited).1fs "
+                              "spent waiting." % retries)
+
+    # Commands return False when they didn't do everything they were asked
+    # to, like a batch upload with failed files; None means success too.
+    if result is False:
+        return 1
 
 if __name__ == "__main__":
     sys.exit(main())
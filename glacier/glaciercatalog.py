@@ -0,0 +1,586 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+glaciercatalog.py
+
+Local catalog of archives, kept in an SQLite database so lookups don't
+need a round trip to SimpleDB. Uploads and inventories are recorded in
+it, and it can be synchronised with the SimpleDB bookkeeping domain.
+Vault inventories are kept as snapshots, so they can be shown again
+without downloading them and compared with each other. For pack archives
+(many small files uploaded as one archive) the offset, size and tree hash
+of every member are kept, so single members can be fetched with ranged
+requests. A file whose content was already stored is kept as a member
+spanning the whole archive. For files uploaded incrementally every version
+has a manifest saying which archive (and where in it) each 1MB chunk is.
+Retrieval jobs are cached by archive ID, with the files their output is
+wanted in, so they can be found without listing the vault's jobs.
+Deleted archives are kept, marked as deleted, so that an inventory taken
+before the deletion doesn't bring them back.
+
+Example usage:
+
+    catalog = GlacierCatalog(os.path.expanduser("~/.glacier-catalog.db"))
+    catalog.add_archive(region="us-east-1", vault="Test", archive_id=archive_id,
+                        filename="/path/SomeFile", description="SomeFile")
+    for item in catalog.search(vault="Test", search_term="/path/"):
+        print item['archive_id']
+"""
+
+import sys
+import sqlite3
+import threading
+
+ARCHIVE_FIELDS = ('archive_id', 'region', 'vault', 'filename', 'description',
+                  'location', 'date', 'hash', 'size')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS archives (
+    archive_id TEXT PRIMARY KEY,
+    region TEXT,
+    vault TEXT,
+    filename TEXT,
+    description TEXT,
+    location TEXT,
+    date TEXT,
+    hash TEXT,
+    size INTEGER,
+    synced INTEGER NOT NULL DEFAULT 0,
+    deleted INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS archives_vault ON archives (region, vault);
+CREATE INDEX IF NOT EXISTS archives_filename ON archives (filename);
+CREATE INDEX IF NOT EXISTS archives_description ON archives (description);
+CREATE INDEX IF NOT EXISTS archives_hash ON archives (hash);
+CREATE TABLE IF NOT EXISTS inventories (
+    id INTEGER PRIMARY KEY,
+    region TEXT,
+    vault TEXT,
+    inventory_date TEXT,
+    job_id TEXT,
+    vault_arn TEXT,
+    UNIQUE (region, vault, inventory_date)
+);
+CREATE INDEX IF NOT EXISTS inventories_job ON inventories (job_id);
+CREATE TABLE IF NOT EXISTS inventory_archives (
+    inventory_id INTEGER,
+    archive_id TEXT,
+    description TEXT,
+    creation_date TEXT,
+    size INTEGER,
+    hash TEXT,
+    PRIMARY KEY (inventory_id, archive_id)
+);
+CREATE TABLE IF NOT EXISTS pack_members (
+    archive_id TEXT,
+    filename TEXT,
+    offset INTEGER,
+    size INTEGER,
+    hash TEXT,
+    PRIMARY KEY (archive_id, filename)
+);
+CREATE INDEX IF NOT EXISTS pack_members_filename ON pack_members (filename);
+CREATE TABLE IF NOT EXISTS file_versions (
+    id INTEGER PRIMARY KEY,
+    region TEXT,
+    vault TEXT,
+    filename TEXT,
+    version INTEGER,
+    size INTEGER,
+    hash TEXT,
+    date TEXT,
+    UNIQUE (region, vault, filename, version)
+);
+CREATE TABLE IF NOT EXISTS version_chunks (
+    version_id INTEGER,
+    chunk INTEGER,
+    hash TEXT,
+    archive_id TEXT,
+    offset INTEGER,
+    PRIMARY KEY (version_id, chunk)
+);
+CREATE TABLE IF NOT EXISTS transfer_stats (
+    region TEXT PRIMARY KEY,
+    latency REAL,
+    bandwidth REAL,
+    concurrency INTEGER
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    region TEXT,
+    vault TEXT,
+    archive_id TEXT,
+    job_id TEXT,
+    created TEXT,
+    PRIMARY KEY (region, vault, archive_id)
+);
+CREATE TABLE IF NOT EXISTS job_outputs (
+    job_id TEXT,
+    out_file TEXT,
+    PRIMARY KEY (job_id, out_file)
+);
+"""
+
+JOB_FIELDS = ('region', 'vault', 'archive_id', 'job_id', 'created')
+
+VERSION_FIELDS = ('id', 'filename', 'version', 'size', 'hash', 'date')
+
+MEMBER_FIELDS = ('archive_id', 'filename', 'offset', 'size', 'hash')
+
+INVENTORY_FIELDS = (('ArchiveId', 'archive_id'),
+                    ('ArchiveDescription', 'description'),
+                    ('CreationDate', 'creation_date'),
+                    ('Size', 'size'),
+                    ('SHA256TreeHash', 'hash'))
+
+# Rows fetched at a time when reading stored inventories.
+FETCH_SIZE = 1000
+
+# SimpleDB accepts at most 25 items per BatchPutAttributes call.
+SIMPLEDB_BATCH_SIZE = 25
+
+FILENAME_ENCODING = sys.getfilesystemencoding() or "utf-8"
+
+def to_text(value):
+    """
+    Decode a byte string (as paths and command line arguments are on
+    Python 2) with the file system encoding. SQLite refuses byte strings
+    that aren't ASCII, and text compares the same way as stored names.
+    """
+    if isinstance(value, str):
+        return value.decode(FILENAME_ENCODING, "replace")
+    return value
+
+def to_bytes(value):
+    """
+    The reverse of to_text, for names read from the catalog that are
+    printed or used as paths.
+    """
+    if isinstance(value, unicode):
+        return value.encode(FILENAME_ENCODING, "replace")
+    return value
+
+def prefix_upper_bound(prefix):
+    """
+    Smallest string that is greater than every string starting with
+    prefix, so prefix searches can be answered from an index with
+    `column >= prefix AND column < bound`.
+    """
+    prefix = to_text(prefix)
+    return prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
+class GlacierCatalog(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.lock:
+            self.db.executescript(SCHEMA)
+            columns = [row[1] for row in self.db.execute("PRAGMA table_info(archives)")]
+            if 'deleted' not in columns:
+                # Catalogs created before deletions were recorded.
+                with self.db:
+                    self.db.execute("ALTER TABLE archives ADD COLUMN "
+                                    "deleted INTEGER NOT NULL DEFAULT 0")
+            columns = [row[1] for row in self.db.execute("PRAGMA table_info(jobs)")]
+            if 'out_file' in columns:
+                # Catalogs that kept one output file per job, in the jobs table.
+                with self.db:
+                    self.db.execute("INSERT OR IGNORE INTO job_outputs (job_id, out_file) "
+                                    "SELECT job_id, out_file FROM jobs WHERE out_file IS NOT NULL")
+                    self.db.execute("UPDATE jobs SET out_file = NULL")
+
+    def close(self):
+        self.db.close()
+
+    def add_archive(self, **attrs):
+        """
+        Record an archive, replacing any earlier record of it.
+        """
+        self.add_archives([attrs])
+
+    def add_archives(self, archives, replace=True, synced=False):
+        """
+        Record many archives in one transaction. With replace=False,
+        archives that are already in the catalog are left as they are.
+        """
+        query = "INSERT OR %s INTO archives (%s, synced) VALUES (%s, ?)" % (
+                    "REPLACE" if replace else "IGNORE",
+                    ", ".join(ARCHIVE_FIELDS),
+                    ", ".join("?" * len(ARCHIVE_FIELDS)))
+        rows = ([to_text(archive.get(field)) for field in ARCHIVE_FIELDS] + [int(synced)]
+                for archive in archives)
+        with self.lock:
+            with self.db:
+                self.db.executemany(query, rows)
+
+    def delete_archive(self, archive_id):
+        """
+        Mark an archive as deleted. It is kept so that inventories taken
+        before the deletion, which still list it, don't add it again.
+        """
+        with self.lock:
+            with self.db:
+                self.db.execute("INSERT OR IGNORE INTO archives (archive_id) VALUES (?)",
+                                (archive_id,))
+                self.db.execute("UPDATE archives SET deleted = 1 WHERE archive_id = ?",
+                                (archive_id,))
+
+    def search(self, region=None, vault=None, search_term=None):
+        """
+        Return the archives (as dicts) in the given region and vault whose
+        filename or description starts with search_term.
+        """
+        conditions = ["deleted = 0"]
+        params = []
+        if region:
+            conditions.append("region = ?")
+            params.append(region)
+        if vault:
+            conditions.append("vault = ?")
+            params.append(vault)
+        if search_term:
+            search_term = to_text(search_term)
+            conditions.append("((filename >= ? AND filename < ?) OR "
+                              "(description >= ? AND description < ?))")
+            params += [search_term, prefix_upper_bound(search_term)] * 2
+        query = "SELECT %s FROM archives WHERE %s" % (", ".join(ARCHIVE_FIELDS),
+                                                      " AND ".join(conditions))
+        with self.lock:
+            rows = self.db.execute(query, params).fetchall()
+        return [dict(zip(ARCHIVE_FIELDS, row)) for row in rows]
+
+    def get_archive(self, archive_id):
+        with self.lock:
+            row = self.db.execute("SELECT %s FROM archives WHERE archive_id = ? AND deleted = 0"
+                                  % (", ".join(ARCHIVE_FIELDS),), (archive_id,)).fetchone()
+        return dict(zip(ARCHIVE_FIELDS, row)) if row else None
+
+    def find_hash(self, region, vault, tree_hash):
+        """
+        Return an archive (as a dict) in the vault with the given tree
+        hash, or None. Uploads, inventories and SimpleDB records all end
+        up in the catalog, so this knows about every archive seen. Deleted
+        archives don't count.
+        """
+        with self.lock:
+            row = self.db.execute("SELECT %s FROM archives WHERE hash = ? AND region = ? "
+                                  "AND vault = ? AND deleted = 0 LIMIT 1"
+                                  % (", ".join(ARCHIVE_FIELDS),),
+                                  (tree_hash, region, vault)).fetchone()
+        return dict(zip(ARCHIVE_FIELDS, row)) if row else None
+
+    def sync_simpledb(self, domain, pull=True):
+        """
+        Push the archives SimpleDB doesn't have yet to the bookkeeping
+        domain, in batches, and (with pull) fetch the ones only SimpleDB
+        knows about. Returns the number of archives pushed and pulled.
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT %s FROM archives WHERE synced = 0 AND deleted = 0"
+                                   % (", ".join(ARCHIVE_FIELDS),)).fetchall()
+        pushed = [dict(zip(ARCHIVE_FIELDS, row)) for row in rows]
+        for i in range(0, len(pushed), SIMPLEDB_BATCH_SIZE):
+            batch = pushed[i:i + SIMPLEDB_BATCH_SIZE]
+            domain.batch_put_attributes(dict(
+                (archive['filename'] or archive['archive_id'],
+                 dict((k, unicode(v)) for k, v in archive.items() if v is not None))
+                for archive in batch))
+            with self.lock:
+                with self.db:
+                    self.db.executemany("UPDATE archives SET synced = 1 WHERE archive_id = ?",
+                                        [(archive['archive_id'],) for archive in batch])
+
+        if not pull:
+            return len(pushed), 0
+        pulled = [dict(item) for item in domain.select('select * from `%s`' % (domain.name,))
+                  if item.get('archive_id')]
+        for item in pulled:
+            if item.get('size'):
+                item['size'] = int(item['size'])
+        before = self.db.total_changes
+        self.add_archives(pulled, replace=False, synced=True)
+        return len(pushed), self.db.total_changes - before
+
+    def add_inventory(self, region, vault, job_id, header, archives):
+        """
+        Store the output of an inventory retrieval job as the snapshot of
+        the vault at its InventoryDate, and add the archives in it to the
+        catalog. archives may be any iterable (like an InventoryReader);
+        it is consumed as it is stored, and header only needs to be filled
+        in once it is exhausted.
+        """
+        columns = ", ".join(column for key, column in INVENTORY_FIELDS)
+        with self.lock:
+            with self.db:
+                inventory_id = self.db.execute("INSERT INTO inventories (region, vault, job_id) "
+                                               "VALUES (?, ?, ?)", (region, vault, job_id)).lastrowid
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO inventory_archives (inventory_id, %s) "
+                    "VALUES (?, %s)" % (columns, ", ".join("?" * len(INVENTORY_FIELDS))),
+                    ([inventory_id] + [archive[key] for key, column in INVENTORY_FIELDS]
+                     for archive in archives))
+
+                # Replace an earlier copy of the same snapshot.
+                self.db.execute(
+                    "DELETE FROM inventory_archives WHERE inventory_id IN "
+                    "(SELECT id FROM inventories WHERE region = ? AND vault = ? "
+                    "AND inventory_date = ?)", (region, vault, header['InventoryDate']))
+                self.db.execute("DELETE FROM inventories WHERE region = ? AND vault = ? "
+                                "AND inventory_date = ?", (region, vault, header['InventoryDate']))
+                self.db.execute("UPDATE inventories SET inventory_date = ?, vault_arn = ? "
+                                "WHERE id = ?",
+                                (header['InventoryDate'], header['VaultARN'], inventory_id))
+
+                self.db.execute(
+                    "INSERT OR IGNORE INTO archives (archive_id, region, vault, filename, "
+                    "description, date, hash, size, synced) "
+                    "SELECT archive_id, ?, ?, description, description, creation_date, hash, "
+                    "size, 1 FROM inventory_archives WHERE inventory_id = ?",
+                    (region, vault, inventory_id))
+        return inventory_id
+
+    def list_inventories(self, region, vault):
+        """
+        Return the (inventory date, job ID) of the stored snapshots of a
+        vault, newest first.
+        """
+        with self.lock:
+            return [tuple(row) for row in self.db.execute(
+                "SELECT inventory_date, job_id FROM inventories WHERE region = ? AND vault = ? "
+                "ORDER BY inventory_date DESC", (region, vault))]
+
+    def find_inventory(self, region, vault, job_id=None, inventory_date=None):
+        query = "SELECT id, inventory_date, vault_arn FROM inventories WHERE region = ? AND vault = ?"
+        params = [region, vault]
+        if job_id:
+            query += " AND job_id = ?"
+            params.append(job_id)
+        if inventory_date:
+            query += " AND inventory_date = ?"
+            params.append(inventory_date)
+        with self.lock:
+            return self.db.execute(query, params).fetchone()
+
+    def get_inventory(self, region, vault, job_id=None, inventory_date=None):
+        """
+        Return a stored snapshot, in the same form as the output of the
+        inventory retrieval job, or None if there is no such snapshot.
+        ArchiveList is a generator reading the archives from the database.
+        """
+        found = self.find_inventory(region, vault, job_id, inventory_date)
+        if found is None:
+            return None
+        inventory_id, inventory_date, vault_arn = found
+        return {'VaultARN': vault_arn,
+                'InventoryDate': inventory_date,
+                'ArchiveList': self.inventory_archives(inventory_id)}
+
+    def inventory_archives(self, inventory_id, query="", params=()):
+        keys = [key for key, column in INVENTORY_FIELDS]
+        columns = ", ".join(column for key, column in INVENTORY_FIELDS)
+        with self.lock:
+            cursor = self.db.execute(
+                "SELECT %s FROM inventory_archives WHERE inventory_id = ?%s ORDER BY creation_date"
+                % (columns, query), (inventory_id,) + tuple(params))
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield dict(zip(keys, row))
+
+    def diff_inventories(self, region, vault, old_date, new_date):
+        """
+        Compare two snapshots of a vault. Returns generators of the
+        archives that were added and removed between them.
+        """
+        old = self.find_inventory(region, vault, inventory_date=old_date)
+        new = self.find_inventory(region, vault, inventory_date=new_date)
+        if old is None or new is None:
+            raise Exception(u"No inventory of %s from %s." % (vault, new_date if old else old_date))
+        missing = (" AND archive_id NOT IN (SELECT archive_id FROM inventory_archives "
+                   "WHERE inventory_id = ?)")
+        added = self.inventory_archives(new[0], missing, (old[0],))
+        removed = self.inventory_archives(old[0], missing, (new[0],))
+        return added, removed
+
+    def add_members(self, archive_id, members):
+        """
+        Record members (dicts with filename, offset, size and hash) of the
+        pack archive archive_id. While the pack is being uploaded its
+        upload ID can stand in for archive_id; see finish_pack.
+        """
+        with self.lock:
+            with self.db:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO pack_members (%s) VALUES (%s)"
+                    % (", ".join(MEMBER_FIELDS), ", ".join("?" * len(MEMBER_FIELDS))),
+                    ([archive_id] + [to_text(member[field]) for field in MEMBER_FIELDS[1:]]
+                     for member in members))
+
+    def finish_pack(self, upload_id, archive_id=None):
+        """
+        Move the members recorded under upload_id to the finished archive,
+        or forget them if the upload failed (archive_id is None).
+        """
+        with self.lock:
+            with self.db:
+                if archive_id is None:
+                    self.db.execute("DELETE FROM pack_members WHERE archive_id = ?",
+                                    (upload_id,))
+                else:
+                    self.db.execute("UPDATE pack_members SET archive_id = ? WHERE archive_id = ?",
+                                    (archive_id, upload_id))
+
+    def search_members(self, region=None, vault=None, search_term=None):
+        """
+        Return the pack members (as dicts, with the region and vault of
+        their pack) whose filename starts with search_term.
+        """
+        conditions = ["archives.deleted = 0"]
+        params = []
+        if region:
+            conditions.append("archives.region = ?")
+            params.append(region)
+        if vault:
+            conditions.append("archives.vault = ?")
+            params.append(vault)
+        if search_term:
+            search_term = to_text(search_term)
+            conditions.append("pack_members.filename >= ? AND pack_members.filename < ?")
+            params += [search_term, prefix_upper_bound(search_term)]
+        fields = ["pack_members.%s" % (field,) for field in MEMBER_FIELDS]
+        query = ("SELECT %s, archives.region, archives.vault FROM pack_members "
+                 "JOIN archives ON archives.archive_id = pack_members.archive_id "
+                 "WHERE %s" % (", ".join(fields), " AND ".join(conditions)))
+        with self.lock:
+            rows = self.db.execute(query, params).fetchall()
+        return [dict(zip(MEMBER_FIELDS + ('region', 'vault'), row)) for row in rows]
+
+    def get_version(self, region, vault, filename, version=None):
+        """
+        Return a version (the latest by default) of an incrementally
+        uploaded file as a dict, or None.
+        """
+        query = ("SELECT %s FROM file_versions WHERE region = ? AND vault = ? AND filename = ?"
+                 % (", ".join(VERSION_FIELDS),))
+        params = [region, vault, to_text(filename)]
+        if version is not None:
+            query += " AND version = ?"
+            params.append(version)
+        with self.lock:
+            row = self.db.execute(query + " ORDER BY version DESC LIMIT 1", params).fetchone()
+        return dict(zip(VERSION_FIELDS, row)) if row else None
+
+    def version_chunks(self, version_id):
+        """
+        The manifest of a version: (hash, archive ID, offset) of every 1MB
+        chunk of the file, in order.
+        """
+        with self.lock:
+            return [tuple(row) for row in self.db.execute(
+                "SELECT hash, archive_id, offset FROM version_chunks WHERE version_id = ? "
+                "ORDER BY chunk", (version_id,))]
+
+    def add_version(self, region, vault, filename, size, tree_hash, date, chunks):
+        """
+        Record a new version of a file with its manifest, a list of
+        (hash, archive ID, offset) per chunk. Returns the version number.
+        """
+        filename = to_text(filename)
+        with self.lock:
+            with self.db:
+                latest = self.db.execute("SELECT MAX(version) FROM file_versions WHERE region = ? "
+                                         "AND vault = ? AND filename = ?",
+                                         (region, vault, filename)).fetchone()[0]
+                version = (latest or 0) + 1
+                version_id = self.db.execute(
+                    "INSERT INTO file_versions (region, vault, filename, version, size, hash, date) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (region, vault, filename, version, size, tree_hash, date)).lastrowid
+                self.db.executemany(
+                    "INSERT INTO version_chunks (version_id, chunk, hash, archive_id, offset) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    ((version_id, i) + tuple(chunk) for i, chunk in enumerate(chunks)))
+        return version
+
+    def get_transfer_stats(self, region):
+        """
+        Request latency, per-connection bandwidth and concurrency measured
+        by the last tuned upload to the region, as a dict (empty if none).
+        """
+        with self.lock:
+            row = self.db.execute("SELECT latency, bandwidth, concurrency FROM transfer_stats "
+                                  "WHERE region = ?", (region,)).fetchone()
+        return dict(zip(('latency', 'bandwidth', 'concurrency'), row)) if row else {}
+
+    def set_transfer_stats(self, region, latency, bandwidth, concurrency):
+        with self.lock:
+            with self.db:
+                self.db.execute("INSERT OR REPLACE INTO transfer_stats "
+                                "(region, latency, bandwidth, concurrency) VALUES (?, ?, ?, ?)",
+                                (region, latency, bandwidth, concurrency))
+
+    def add_job(self, region, vault, archive_id, job_id, created=None, out_file=None):
+        """
+        Remember the retrieval job of an archive, replacing any earlier one,
+        and optionally a file its output is wanted in.
+        """
+        with self.lock:
+            with self.db:
+                self.db.execute("INSERT OR REPLACE INTO jobs (%s) VALUES (?, ?, ?, ?, ?)"
+                                % (", ".join(JOB_FIELDS),),
+                                (region, vault, archive_id, job_id, created))
+        if out_file:
+            self.add_job_output(job_id, out_file)
+
+    def get_job(self, region, vault, archive_id):
+        with self.lock:
+            row = self.db.execute("SELECT %s FROM jobs WHERE region = ? AND vault = ? "
+                                  "AND archive_id = ?" % (", ".join(JOB_FIELDS),),
+                                  (region, vault, archive_id)).fetchone()
+        return dict(zip(JOB_FIELDS, row)) if row else None
+
+    def add_job_output(self, job_id, out_file):
+        """
+        Add a file the output of a job should be downloaded to. A job can
+        have several, when its archive is wanted in more than one place.
+        """
+        with self.lock:
+            with self.db:
+                self.db.execute("INSERT OR IGNORE INTO job_outputs (job_id, out_file) "
+                                "VALUES (?, ?)", (job_id, to_text(out_file)))
+
+    def remove_job_output(self, job_id, out_file):
+        """
+        Forget a file the output of a job was wanted in, once it has been
+        downloaded there.
+        """
+        with self.lock:
+            with self.db:
+                self.db.execute("DELETE FROM job_outputs WHERE job_id = ? AND out_file = ?",
+                                (job_id, to_text(out_file)))
+
+    def waiting_jobs(self, region, vault=None):
+        """
+        Cached jobs whose output is still to be downloaded, oldest first,
+        once for every file it is wanted in (as out_file).
+        """
+        query = ("SELECT %s, job_outputs.out_file FROM jobs JOIN job_outputs "
+                 "ON job_outputs.job_id = jobs.job_id WHERE jobs.region = ?"
+                 % (", ".join("jobs.%s" % (field,) for field in JOB_FIELDS),))
+        params = [region]
+        if vault:
+            query += " AND jobs.vault = ?"
+            params.append(vault)
+        with self.lock:
+            rows = self.db.execute(query + " ORDER BY jobs.created", params).fetchall()
+        return [dict(zip(JOB_FIELDS + ('out_file',), row)) for row in rows]
+
+    def delete_job(self, job_id):
+        with self.lock:
+            with self.db:
+                self.db.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+                self.db.execute("DELETE FROM job_outputs WHERE job_id = ?", (job_id,))
@@ -21,15 +21,198 @@
 #     # Get the id of the newly created archive
 #     archive_id = writer.get_archive_id()from boto.connection import AWSAuthConnection
 
+import os
 import urllib
 import hashlib
+import binascii
+import mmap
 import math
 import json
 import sys
+import time
+import random
+import heapq
+import itertools
+import threading
+import Queue
+from multiprocessing.pool import ThreadPool
 
 from boto.connection import AWSAuthConnection
 
+class GlacierError(Exception):
+    """
+    Glacier answered with an unexpected status. Like the other errors
+    here, the response body is e[1], so its JSON message can be shown.
+    """
+    def __init__(self, what, status, body):
+        Exception.__init__(self, "%s (got %s)" % (what, status), body)
+        self.status = status
+        self.body = body
+
+    def __str__(self):
+        return "%s: %s" % self.args
+
+def check_response(response, statuses, what):
+    """
+    Raise a GlacierError unless response has one of the expected statuses.
+    """
+    if response.status not in statuses:
+        raise GlacierError(what, response.status, response.read())
+    return response
+
+class RetryPolicy(object):
+    """
+    Decides which failed Glacier requests are retried, and how long to
+    wait first: jittered exponential backoff, a random time of up to
+    base_delay * 2**attempt (at most max_delay) seconds.
+
+    Socket errors and 5xx responses are retried up to max_retries times,
+    but only for idempotent requests (see GlacierConnection.make_request).
+    Throttling responses back off from throttle_delay instead, and hold
+    back every request going through the policy until then, since more
+    requests would only be throttled as well.
+
+    retries counts the retries by reason ('error', 'server', 'throttled')
+    and waited the seconds spent waiting for them.
+    """
+    THROTTLING_CODES = ('ThrottlingException', 'RequestTimeoutException', 'SlowDown')
+
+    def __init__(self, max_retries=5, base_delay=0.5, max_delay=30, throttle_delay=2):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.throttle_delay = throttle_delay
+        self.lock = threading.Lock()
+        self.throttled_until = 0
+        self.retries = {'error': 0, 'server': 0, 'throttled': 0}
+        self.waited = 0.0
+
+    def reason(self, response):
+        """
+        Why response should be retried, or None.
+        """
+        if response.status >= 500:
+            return 'server'
+        if response.status in (400, 408, 429):
+            try:
+                code = json.loads(response.read()).get('code')
+            except ValueError:
+                code = None
+            if code in self.THROTTLING_CODES or response.status == 429:
+                return 'throttled'
+        return None
+
+    def wait(self):
+        """
+        Hold back a request while Glacier is throttling.
+        """
+        delay = self.throttled_until - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def backoff(self, reason, attempt):
+        base = self.throttle_delay if reason == 'throttled' else self.base_delay
+        delay = random.uniform(0, min(self.max_delay, base * 2 ** attempt))
+        with self.lock:
+            self.retries[reason] += 1
+            self.waited += delay
+            if reason == 'throttled':
+                self.throttled_until = max(self.throttled_until, time.time() + delay)
+        time.sleep(delay)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.retries)
+            stats['waited'] = self.waited
+        return stats
+
+retry_policy = RetryPolicy()
+
+class GlacierConnectionPool(object):
+    """
+    Keep-alive pool of HTTP(S) connections to Glacier.
+
+    Replaces boto's per-connection-object pool so that every
+    GlacierConnection in the process, and every thread using one, shares
+    the same idle connections. At most `size` idle connections are kept
+    per host, and the most recently used one is handed out first since
+    it is the least likely to have been closed by the server. Connections
+    idle for longer than idle_timeout are closed and dropped.
+
+    Like boto, _mexe returns connections before their response has been
+    read; those are only handed out again once the response is closed.
+
+    `created` counts new connections (and so TLS handshakes for https),
+    `reused` counts requests that went over an existing one.
+    """
+    DEFAULT_SIZE = 10
+    IDLE_TIMEOUT = 30
+
+    def __init__(self, size=DEFAULT_SIZE, idle_timeout=IDLE_TIMEOUT):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.hosts = {}
+        self.created = 0
+        self.reused = 0
+        self.handshakes_avoided = 0
+
+    def reserve(self, size):
+        """
+        Make sure the pool keeps enough connections for `size` threads.
+        """
+        with self.lock:
+            self.size = max(self.size, size)
+
+    def get(self, host, port, is_secure):
+        now = time.time()
+        with self.lock:
+            idle = []
+            found = None
+            for conn, since in self.hosts.get((host, port, is_secure), []):
+                response = getattr(conn, '_HTTPConnection__response', None)
+                if response is not None and not response.isclosed():
+                    # Somebody is still reading from it.
+                    idle.append((conn, now))
+                elif now - since < self.idle_timeout:
+                    if found is not None:
+                        idle.append(found)
+                    found = (conn, since)
+                else:
+                    # Idle too long, the server has likely dropped it.
+                    conn.close()
+            self.hosts[(host, port, is_secure)] = idle
+            if found is None:
+                return None
+            self.reused += 1
+            if is_secure:
+                self.handshakes_avoided += 1
+            return found[0]
+
+    def put(self, host, port, is_secure, conn):
+        with self.lock:
+            idle = self.hosts.setdefault((host, port, is_secure), [])
+            idle.append((conn, time.time()))
+            if len(idle) > self.size:
+                # Not closed here: somebody may still be reading from it.
+                del idle[0]
+
+    def count_created(self):
+        with self.lock:
+            self.created += 1
+
+    def stats(self):
+        with self.lock:
+            return {'created': self.created,
+                    'reused': self.reused,
+                    'handshakes_avoided': self.handshakes_avoided,
+                    'idle': sum(len(idle) for idle in self.hosts.values())}
+
+connection_pool = GlacierConnectionPool()
+
 class GlacierConnection(AWSAuthConnection):
+    # Glacier's POSTs start jobs and multipart uploads, or complete them.
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
 
     def __init__(self, aws_access_key_id=None, aws_secret_access_key=None,
                  region="us-east-1",
@@ -37,7 +220,9 @@ class GlacierConnection(AWSAuthConnection):
                  proxy_user=None, proxy_pass=None,
                  host=None, debug=0, https_connection_factory=None,
                  path='/', provider='aws',  security_token=None,
-                 suppress_consec_slashes=True):
+                 suppress_consec_slashes=True, pool=None, retry=None):
+        self.connection_pool = pool or connection_pool
+        self.retry_policy = retry or retry_policy
         if host is None:
             host = 'glacier.%s.amazonaws.com' % (region,)
         AWSAuthConnection.__init__(self, host,
@@ -47,21 +232,111 @@ class GlacierConnection(AWSAuthConnection):
                 path=path, provider=provider, security_token=security_token,
                 suppress_consec_slashes=suppress_consec_slashes)
 
+        # Part uploads send the SHA-256 of their body, which is what the
+        # signature needs. Use it rather than have boto hash the part
+        # again (which it can't do for buffer and memoryview bodies).
+        payload = self._auth_handler.payload
+        self._auth_handler.payload = lambda request: \
+                request.headers.get('x-amz-content-sha256') or payload(request)
+
     def _required_auth_capability(self):
         return ["hmac-v4"]
 
+    def get_http_connection(self, host, port, is_secure):
+        conn = self.connection_pool.get(host, port, is_secure)
+        if conn is None:
+            conn = self.new_http_connection(host, port, is_secure)
+        return conn
+
+    def new_http_connection(self, host, port, is_secure):
+        self.connection_pool.count_created()
+        return super(GlacierConnection, self).new_http_connection(host, port, is_secure)
+
+    def put_http_connection(self, host, port, is_secure, connection):
+        self.connection_pool.put(host, port, is_secure, connection)
+
+    def _mexe(self, request, sender=None, override_num_retries=None,
+              retry_handler=None):
+        """
+        Send a signed request once, over a connection from the pool, and
+        return the response whatever its status. boto's own _mexe sleeps
+        and reconnects after errors even with retries turned off; this
+        leaves all of that to make_request and its retry policy.
+        """
+        connection = self.get_http_connection(request.host, request.port, self.is_secure)
+        if isinstance(request.body, unicode):
+            request.body = request.body.encode('utf-8')
+        request.authorize(connection=self)
+        if not request.headers.get('Host'):
+            self.set_host_header(request)
+        try:
+            if callable(sender):
+                response = sender(connection, request.method, request.path,
+                                  request.body, request.headers)
+            else:
+                connection.request(request.method, request.path,
+                                   request.body, request.headers)
+                response = connection.getresponse()
+        except self.http_exceptions:
+            # Don't hand a broken connection out again.
+            connection.close()
+            raise
+        if response.getheader('connection') == 'close':
+            connection.close()
+        else:
+            self.put_http_connection(request.host, request.port, self.is_secure, connection)
+        return response
+
     def get_vault(self, name):
         return GlacierVault(self, name)
 
     def make_request(self, method, path, headers=None, data='', host=None,
                      auth_path=None, sender=None, override_num_retries=None,
                      params=None):
+        """
+        Make a request, retrying it as the retry policy says. Every
+        attempt sends the same data, so part uploads are re-sent from the
+        part buffer they came from. boto's own retries are turned off.
+        A 5xx response that is still there after the last retry raises
+        a GlacierError.
+
+        Throttled requests weren't acted on and are always retried, but
+        after a socket error or a 5xx Glacier may have done what was
+        asked, so those are only retried for IDEMPOTENT_METHODS. Another
+        try of a POST could start a second job or upload.
+        """
         headers = headers or {}
         headers.setdefault("x-amz-glacier-version","2012-06-01")
-        return super(GlacierConnection, self).make_request(method, path, headers,
-                                                           data, host, auth_path,
-                                                           sender, override_num_retries,
-                                                           params=params)
+        policy = self.retry_policy
+        if override_num_retries is not None:
+            policy = RetryPolicy(max_retries=override_num_retries)
+        attempt = 0
+        while True:
+            policy.wait()
+            response = None
+            try:
+                response = super(GlacierConnection, self).make_request(method, path, dict(headers),
+                                                                       data, host, auth_path,
+                                                                       sender, 0, params=params)
+                reason = policy.reason(response)
+            except self.http_exceptions:
+                reason = 'error'
+                error = sys.exc_info()
+            if reason is None:
+                return response
+            if attempt >= policy.max_retries or (reason != 'throttled' and
+                                                 method not in self.IDEMPOTENT_METHODS):
+                if response is None:
+                    raise error[0], error[1], error[2]
+                if reason == 'server':
+                    raise GlacierError("%s %s failed after %d tries" % (method, path, attempt + 1),
+                                       response.status, response.read())
+                return response
+            if response is not None:
+                # Free the connection for the next attempt.
+                response.read()
+            policy.backoff(reason, attempt)
+            attempt += 1
 
     def list_vaults(self, marker=None):
         if marker:
@@ -128,16 +403,45 @@ class GlacierVault(object):
     def get_job(self, job_id):
         return GlacierJob(self, job_id=job_id)
 
-    def list_jobs(self):
-        response = self.make_request("GET", "/jobs", None)
+    def list_jobs(self, marker=None, completed=None, status_code=None, limit=None):
+        """
+        Fetch one page of the vault's jobs into job_list, and the marker of
+        the next page into job_marker (None after the last page). Glacier
+        filters the jobs by completed and status_code ("InProgress",
+        "Succeeded" or "Failed"); limit is the page size, at most 1000.
+        """
+        params = {}
+        if marker:
+            params['marker'] = marker
+        if completed is not None:
+            params['completed'] = "true" if completed else "false"
+        if status_code:
+            params['statuscode'] = status_code
+        if limit:
+            params['limit'] = str(limit)
+        response = self.make_request("GET", "/jobs", None, params=params)
 
-        assert response.status == 200,\
-                "List job expected 200 back (got %s): %r"\
-                    % (response.status, response.read())
+        check_response(response, (200,), "List job expected 200 back")
         jdata = json.loads(response.read())
         self.job_list = jdata['JobList']
+        self.job_marker = jdata.get('Marker')
         return response
 
+    def iter_jobs(self, completed=None, status_code=None, limit=None):
+        """
+        Yield all the vault's jobs that pass the list_jobs filters, one at
+        a time. Pages are only fetched when the previous one is used up,
+        so callers that stop at the job they look for save requests.
+        """
+        marker = None
+        while True:
+            self.list_jobs(marker, completed, status_code, limit)
+            for job in self.job_list:
+                yield job
+            marker = self.job_marker
+            if not marker:
+                break
+
     def create_vault(self):
         return self.make_request("PUT", extra_path=None)
 
@@ -159,6 +463,25 @@ class GlacierVault(object):
         else:
             return self.make_request("GET", extra_path="/multipart-uploads/%s" % (multipart_id, ))
 
+    def list_all_parts(self, multipart_id):
+        """
+        Page through list_parts and return a dict mapping the offset of
+        every part already stored for the multipart upload to its
+        (size, hex tree hash).
+        """
+        parts = {}
+        marker = None
+        while True:
+            response = self.list_parts(multipart_id, marker)
+            check_response(response, (200,), "List parts expected 200 back")
+            jdata = json.loads(response.read())
+            for part in jdata['Parts']:
+                start, end = [int(x) for x in part['RangeInBytes'].split('-')]
+                parts[start] = (end - start + 1, part['SHA256TreeHash'])
+            marker = jdata.get('Marker')
+            if not marker:
+                return parts
+
     def delete_archive(self, archive_id):
         return self.make_request("DELETE", extra_path="/archives/%s" % (archive_id, ))
 
@@ -177,9 +500,7 @@ class GlacierJob(object):
                     "x-amz-glacier-version": "2012-06-01",
                   }
         response = self.vault.make_request("POST", "/jobs", headers, json.dumps(self.params))
-        if response.status != 202:
-            msg = "Start job expected 202 back (got %s)" % (response.status, )
-            raise Exception(msg, response.read())
+        check_response(response, (202,), "Start job expected 202 back")
         response.read()
 
         self.job_id = response.getheader("x-amz-job-id")
@@ -192,179 +513,1092 @@ class GlacierJob(object):
                         """If you specify one of range_from or """\
                         """range_to you must specify the other"""
 
-            headers["Range"] = "bytes %d-%d" % (range_from, range_to)
-        response = self.vault.make_request("GET", "/jobs/%s/output" % (urllib.quote(self.job_id),))
-        assert response.status == 200,\
-                "Get output expects 200 responses (got %s): %r"\
-                    % (response.status, response.read())
+            headers["Range"] = "bytes=%d-%d" % (range_from, range_to)
+        response = self.vault.make_request("GET", "/jobs/%s/output" % (urllib.quote(self.job_id),),
+                                           headers)
+        check_response(response, (200, 206), "Get output expects 200 or 206 responses")
         return response
 
+    def write_output(self, out, block_size=1024*1024):
+        """
+        Stream the whole output of the job into the file-like `out` with
+        a single request, block_size bytes at a time, so memory use does
+        not depend on the size of the output. The data is checked against
+        the tree hash Glacier sends with it. Returns the number of bytes
+        written.
+        """
+        response = self.get_output()
+        hasher = TreeHasher(linear=False)
+        size = 0
+        for block in iter((lambda:response.read(block_size)), ''):
+            hasher.update(block)
+            out.write(block)
+            size += len(block)
+        expected = response.getheader("x-amz-sha256-tree-hash")
+        if expected and expected != bytes_to_hex(hasher.tree_hash()):
+            raise Exception("Tree hash mismatch for the output of job %s" % (self.job_id,))
+        return size
+
+    def download_range(self, fd, range_from, range_to, block_size):
+        """
+        Fetch one byte range of the output, write it at its offset in
+        the file open as `fd` and return its tree hash, after checking
+        it against the tree hash Glacier sends for the range.
+        """
+        response = self.get_output(range_from, range_to)
+        hasher = TreeHasher(linear=False)
+        offset = range_from
+        for block in iter((lambda:response.read(block_size)), ''):
+            hasher.update(block)
+            pwrite(fd, block, offset)
+            offset += len(block)
+        if offset != range_to + 1:
+            raise Exception("Range %d-%d of job %s ended after %d bytes"
+                            % (range_from, range_to, self.job_id, offset - range_from))
+        range_hash = hasher.tree_hash()
+        expected = response.getheader("x-amz-sha256-tree-hash")
+        if expected and expected != bytes_to_hex(range_hash):
+            raise Exception("Tree hash mismatch for range %d-%d of job %s"
+                            % (range_from, range_to, self.job_id))
+        return range_hash
+
+    def write_output_range(self, out, offset, size, block_size=1024*1024):
+        """
+        Stream `size` bytes of the output starting at `offset` into the
+        file-like `out` with one ranged request, and return their tree hash
+        (hex). Ranges that don't fall on megabyte boundaries come without a
+        tree hash from Glacier, so the caller checks the returned hash
+        against one recorded at upload time.
+        """
+        hasher = TreeHasher(linear=False)
+        written = 0
+        if size > 0:
+            response = self.get_output(offset, offset + size - 1)
+            for block in iter((lambda:response.read(block_size)), ''):
+                hasher.update(block)
+                out.write(block)
+                written += len(block)
+        if written != size:
+            raise Exception("Range %d-%d of job %s ended after %d bytes"
+                            % (offset, offset + size - 1, self.job_id, written))
+        return bytes_to_hex(hasher.tree_hash())
+
+    JOURNAL_SUFFIX = ".glacier-ranges"
+    CHECKPOINT_RANGE_SIZE = 128*1024*1024
+
+    def download_output(self, filename, concurrency=1, block_size=1024*1024,
+                        resume=False):
+        """
+        Download the output of a completed archive retrieval job into
+        `filename`. The output is split into `concurrency` tree hash
+        aligned byte ranges (a power of two megabytes each) that are
+        fetched at the same time, each by its own thread and connection,
+        and written at their offsets. Every range is checked against its
+        tree hash and the whole file against the archive's tree hash,
+        which is returned.
+
+        With resume, completed ranges (of at most CHECKPOINT_RANGE_SIZE)
+        are recorded in a journal next to the file. A later call fetches
+        only the ranges that are missing and then checks the tree hash of
+        the whole file.
+        """
+        if not hasattr(self, 'archive_size'):
+            self.job_status()
+        size = self.archive_size
+        self.vault.connection.connection_pool.reserve(concurrency)
+        range_size = TreeHasher.CHUNK_SIZE
+        while range_size * concurrency < size:
+            range_size *= 2
+
+        journal = None
+        done = {}
+        if resume:
+            range_size = min(range_size, self.CHECKPOINT_RANGE_SIZE)
+            journal_path = filename + self.JOURNAL_SUFFIX
+            if os.path.exists(journal_path) and os.path.exists(filename):
+                journal = Journal.load(journal_path)
+                if (journal.header.get('job_id') == self.job_id
+                        and journal.header.get('size') == size):
+                    range_size = journal.header['range_size']
+                    done = journal.parts
+                else:
+                    journal = None
+            if journal is None:
+                journal = Journal.create(journal_path, job_id=self.job_id,
+                                         size=size, range_size=range_size)
+
+        ranges = Queue.Queue()
+        range_hashes = []
+        for index, offset in enumerate(xrange(0, size, range_size)):
+            if offset in done:
+                range_hashes.append(binascii.unhexlify(done[offset][1]))
+            else:
+                range_hashes.append(None)
+                ranges.put((index, offset, min(offset + range_size, size) - 1))
+        errors = []
+
+        if not done:
+            with open(filename, 'wb') as f:
+                f.truncate(size)
+
+        def download_worker():
+            fd = os.open(filename, os.O_WRONLY)
+            try:
+                while not errors:
+                    try:
+                        index, range_from, range_to = ranges.get_nowait()
+                    except Queue.Empty:
+                        return
+                    range_hashes[index] = self.download_range(fd, range_from, range_to,
+                                                              block_size)
+                    if journal is not None:
+                        journal.record_part(range_from, range_to - range_from + 1,
+                                            bytes_to_hex(range_hashes[index]))
+            except Exception:
+                errors.append(sys.exc_info())
+            finally:
+                os.close(fd)
+
+        workers = [threading.Thread(target=download_worker)
+                   for i in range(min(concurrency, ranges.qsize()))]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if errors:
+            exc_type, exc_value, exc_tb = errors[0]
+            raise exc_type, exc_value, exc_tb
+
+        if done:
+            # Ranges from an earlier run were written to a file that may
+            # have changed since, so hash what is on disk.
+            archive_hash = bytes_to_hex(file_tree_hash(filename))
+        elif range_hashes:
+            archive_hash = bytes_to_hex(tree_hash(range_hashes))
+        else:
+            archive_hash = hashlib.sha256("").hexdigest()
+        if self.sha256_tree_hash and archive_hash != self.sha256_tree_hash:
+            raise Exception("Tree hash mismatch for the output of job %s: expected %s, got %s"
+                            % (self.job_id, self.sha256_tree_hash, archive_hash))
+        if journal is not None:
+            journal.remove()
+        return archive_hash
+
     def job_status(self):
         response = self.vault.make_request("GET", "/jobs/%s" % (self.job_id,))
 
-        assert response.status == 200,\
-               "Describe job expets 200 (got %s): %s"\
-                    % (response.status, response.read())
-        jdata = json.loads(response.read())
+        check_response(response, (200,), "Describe job expects 200")
+        return self.update(json.loads(response.read()))
+
+    def update(self, jdata):
+        """
+        Take the status of the job from its description, as returned by
+        Describe Job or found in the JobList of List Jobs.
+        """
         self.json_output = jdata
         self.completed = jdata['Completed']
         self.archive_id = jdata['ArchiveId']
         self.created = jdata['CreationDate']
         self.status_code = jdata['StatusCode']
         self.status_msg = jdata['StatusMessage']
+        self.archive_size = jdata.get('ArchiveSizeInBytes')
+        self.sha256_tree_hash = jdata.get('SHA256TreeHash')
         return self
 
-def chunk_hashes(data):
+class JobWatcher(object):
+    """
+    Waits for many jobs at once, polling each with job_status on its own
+    schedule: first when it is added (or after `delay`), then every
+    min_interval seconds, backing off by `backoff` times per poll up to
+    max_interval. Retrievals take hours, so polling them more often only
+    costs requests. Jobs are kept in a heap by the time of their next
+    poll and a single thread sleeps until the next one is due.
+
+    Iterating yields every job as soon as a poll finds it completed (with
+    status_code "Succeeded" or "Failed"). Jobs Glacier no longer knows
+    about, as they expire a day after completing, are yielded with
+    status_code None. Jobs can be added while iterating.
+
+    Example usage:
+
+        watcher = JobWatcher()
+        watcher.add(vault.get_job(job_id))
+        for job in watcher:
+            if job.status_code == "Succeeded":
+                job.download_output(filename)
+    """
+    MIN_INTERVAL = 60
+    MAX_INTERVAL = 15*60
+
+    def __init__(self, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL, backoff=2):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.backoff = backoff
+        self.queue = []
+        self.counter = itertools.count()
+        self.polls = 0
+
+    def __len__(self):
+        return len(self.queue)
+
+    def add(self, job, delay=0):
+        heapq.heappush(self.queue, (time.time() + delay, next(self.counter),
+                                    job, self.min_interval))
+
+    def next_poll(self):
+        """
+        Time of the next poll, or None if no jobs are left.
+        """
+        return self.queue[0][0] if self.queue else None
+
+    def poll(self):
+        """
+        Poll the jobs that are due and return those found completed (or
+        gone), without waiting for the others.
+        """
+        done = []
+        now = time.time()
+        while self.queue and self.queue[0][0] <= now:
+            due, n, job, interval = heapq.heappop(self.queue)
+            self.polls += 1
+            try:
+                job.job_status()
+            except GlacierError, e:
+                if e.status != 404:
+                    raise
+                job.completed = False
+                job.status_code = None
+                done.append(job)
+                continue
+            if job.completed:
+                done.append(job)
+            else:
+                heapq.heappush(self.queue, (time.time() + interval, n, job,
+                                            min(interval * self.backoff, self.max_interval)))
+        return done
+
+    def __iter__(self):
+        while self.queue:
+            wait = self.next_poll() - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            for job in self.poll():
+                yield job
+
+class RetrievalPlanner(object):
+    """
+    Decides when to start the retrieval jobs of many archives. Glacier
+    charges retrievals by the peak hourly retrieval rate, so restoring a
+    lot of data at once costs far more than restoring it over days. Jobs
+    are started in windows of `window` seconds, with at most max_rate
+    bytes and max_jobs jobs per window. An archive bigger than max_rate
+    gets a window of its own. With neither limit every job starts at once.
+
+    The planner remembers its last window, so archives planned later
+    (like ones whose job expired) are added to it while it has room and
+    isn't over, and get the windows after it otherwise.
+
+    Example usage:
+
+        planner = RetrievalPlanner(max_rate=10*1024**3)
+        for start, archive in planner.plan(archives):
+            ...
+    """
+    def __init__(self, max_rate=None, max_jobs=None, window=60*60):
+        self.max_rate = max_rate
+        self.max_jobs = max_jobs
+        self.window = window
+        self.window_start = None
+        self.used = 0
+        self.jobs = 0
+
+    def plan(self, archives, start=None):
+        """
+        Return (start time, archive) pairs, in the order of archives (dicts
+        with a 'size', None when unknown, which counts as nothing).
+        """
+        now = time.time() if start is None else start
+        if self.window_start is None or self.window_start + self.window <= now:
+            self.window_start = now
+            self.used = 0
+            self.jobs = 0
+        plan = []
+        for archive in archives:
+            size = archive.get('size') or 0
+            if self.jobs and ((self.max_rate and self.used + size > self.max_rate) or
+                              (self.max_jobs and self.jobs >= self.max_jobs)):
+                self.window_start += self.window
+                self.used = 0
+                self.jobs = 0
+            plan.append((self.window_start, archive))
+            self.used += size
+            self.jobs += 1
+        return plan
+
+class InventoryReader(object):
+    """
+    Incremental parser for the JSON output of an inventory retrieval job.
+    Iterating over it yields the entries of ArchiveList one at a time as
+    they are read from fo, so memory use doesn't grow with the size of the
+    vault. The other top-level fields (VaultARN, InventoryDate) are put in
+    `header` as they are read.
+
+    Example usage:
+
+        reader = InventoryReader(job.get_output())
+        for archive in reader:
+            print archive['ArchiveId']
+        print reader.header['InventoryDate']
+    """
+    WHITESPACE = " \t\r\n"
+
+    def __init__(self, fo, block_size=64*1024):
+        self.fo = fo
+        self.block_size = block_size
+        self.header = {}
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self):
+        if self.eof:
+            return False
+        data = self.fo.read(self.block_size)
+        if not data:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        Skip whitespace and return the next character.
+        """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in self.WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                raise ValueError("Unexpected end of inventory")
+
+    def expect(self, chars):
+        char = self.peek()
+        if char not in chars:
+            raise ValueError("Expected one of %r in inventory, got %r" % (chars, char))
+        self.pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number at the end of the buffer may continue in the
+                # next block.
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def __iter__(self):
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            if key == "ArchiveList":
+                self.expect("[")
+                if self.peek() == "]":
+                    self.pos += 1
+                else:
+                    while True:
+                        yield self.value()
+                        if self.expect(",]") == "]":
+                            break
+            else:
+                self.header[key] = self.value()
+            if self.expect(",}") == "}":
+                return
+
+def pwrite(fd, data, offset):
+    """
+    Write data at offset, like os.pwrite (which Python 2 lacks). Threads
+    must not share the file descriptor.
+    """
+    if hasattr(os, 'pwrite'):
+        return os.pwrite(fd, data, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.write(fd, data)
+
+hash_pools = {}
+hash_pools_lock = threading.Lock()
+
+def get_hash_pool(workers):
+    """
+    Return a shared pool of `workers` threads for hashing. hashlib
+    releases the GIL while it hashes large buffers, so the threads
+    really do run on several cores.
+    """
+    with hash_pools_lock:
+        if workers not in hash_pools:
+            hash_pools[workers] = ThreadPool(workers)
+        return hash_pools[workers]
+
+def sha256_digest(data):
+    return hashlib.sha256(data).digest()
+
+def chunk_hashes(data, workers=1):
     """
     Break up the byte-string into 1MB chunks and return sha256 hashes
-    for each.
+    for each. With workers > 1 the chunks are hashed by a thread pool.
     """
     chunk = 1024*1024
     chunk_count = int(math.ceil(len(data)/float(chunk)))
-##    chunks = [data[i*chunk:(i+1)*chunk] for i in range(chunk_count)]
-##    return [hashlib.sha256(x).digest() for x in chunks]
-
-    return [hashlib.sha256(data[i*chunk:(i+1)*chunk]).digest() for i in range(chunk_count)]
+    # Slices of a memoryview share the data instead of copying each chunk.
+    view = memoryview(data)
+    chunks = (view[i*chunk:(i+1)*chunk] for i in xrange(chunk_count))
+    if workers > 1 and chunk_count > 1:
+        return get_hash_pool(workers).map(sha256_digest, chunks)
+    return [sha256_digest(x) for x in chunks]
 
 def tree_hash(fo):
     """
     Given a hash of each 1MB chunk (from chunk_hashes) this will hash
     together adjacent hashes until it ends up with one big one. So a
     tree of hashes.
+
+    Every level is combined in place, front to back, so the whole tree
+    takes linear time and no extra lists.
     """
-    hashes = []
-    hashes.extend(fo)
+    hashes = list(fo)
     while len(hashes) > 1:
-        new_hashes = []
-        while True:
-            if len(hashes) > 1:
-                first = hashes.pop(0)
-                second = hashes.pop(0)
-                new_hashes.append(hashlib.sha256(first + second).digest())
-            elif len(hashes) == 1:
-                only = hashes.pop(0)
-                new_hashes.append(only)
-            else:
-                break
-        hashes.extend(new_hashes)
+        count = len(hashes)
+        for i in xrange(0, count - 1, 2):
+            hashes[i // 2] = hashlib.sha256(hashes[i] + hashes[i + 1]).digest()
+        if count % 2:
+            # An odd hash out is promoted to the next level as is.
+            hashes[count // 2] = hashes[count - 1]
+        del hashes[(count + 1) // 2:]
     return hashes[0]
 
-def bytes_to_hex(str):
-    return ''.join( [ "%02x" % ord( x ) for x in str] ).strip()
+class TreeHasher(object):
+    """
+    Incrementally computes Glacier tree hashes. Data can be written in
+    pieces of any size; each 1MB chunk is hashed as soon as it is
+    complete and folded into the tree right away, so the data is never
+    buffered.
+
+    With a part_size the stream is split into parts of that size (a
+    multiple of 1MB) and for every part the (size, tree hash, linear
+    SHA-256) is appended to `parts`. Without one the whole stream is a
+    single part.
+
+    With workers > 1, runs of complete chunks are hashed by a thread
+    pool while the linear SHA-256 is computed on the calling thread. The
+    linear hash is inherently sequential, so pass linear=False when it
+    isn't needed to let the tree hash use all the workers.
+    """
+    CHUNK_SIZE = 1024*1024
+
+    def __init__(self, part_size=None, workers=1, linear=True):
+        self.part_size = part_size
+        self.workers = workers
+        self.linear = linear
+        self.parts = []
+        self.size = 0
+        self.start_part()
+
+    def start_part(self):
+        self.part_fill = 0
+        self.part_linear = hashlib.sha256()
+        self.chunk = hashlib.sha256()
+        self.chunk_fill = 0
+        # Binary counter of completed subtrees as (level, hash) pairs.
+        self.stack = []
+
+    def add_chunk_hash(self, chunk_hash):
+        level = 0
+        while self.stack and self.stack[-1][0] == level:
+            chunk_hash = hashlib.sha256(self.stack.pop()[1] + chunk_hash).digest()
+            level += 1
+        self.stack.append((level, chunk_hash))
+
+    def update_chunks(self, view):
+        """
+        Hash a run of complete chunks with the thread pool.
+        """
+        chunks = [view[i:i + self.CHUNK_SIZE]
+                  for i in xrange(0, len(view), self.CHUNK_SIZE)]
+        result = get_hash_pool(self.workers).map_async(sha256_digest, chunks)
+        if self.linear:
+            self.part_linear.update(view)
+        for chunk_hash in result.get():
+            self.add_chunk_hash(chunk_hash)
+        self.part_fill += len(view)
+        self.size += len(view)
+
+    def update(self, data):
+        view = memoryview(data)
+        offset = 0
+        while offset < len(view):
+            if self.workers > 1 and self.chunk_fill == 0:
+                count = (len(view) - offset) // self.CHUNK_SIZE
+                if self.part_size:
+                    count = min(count, (self.part_size - self.part_fill) // self.CHUNK_SIZE)
+                if count > 1:
+                    take = count * self.CHUNK_SIZE
+                    self.update_chunks(view[offset:offset + take])
+                    offset += take
+                    if self.part_size and self.part_fill == self.part_size:
+                        self.finish_part()
+                    continue
+            take = min(self.CHUNK_SIZE - self.chunk_fill, len(view) - offset)
+            if self.part_size:
+                take = min(take, self.part_size - self.part_fill)
+            piece = view[offset:offset + take]
+            self.chunk.update(piece)
+            if self.linear:
+                self.part_linear.update(piece)
+            self.chunk_fill += take
+            self.part_fill += take
+            self.size += take
+            offset += take
+            if self.chunk_fill == self.CHUNK_SIZE:
+                self.add_chunk_hash(self.chunk.digest())
+                self.chunk = hashlib.sha256()
+                self.chunk_fill = 0
+            if self.part_size and self.part_fill == self.part_size:
+                self.finish_part()
+
+    def finish_part(self):
+        """
+        Finish the current part, including a trailing partial chunk, and
+        return its (size, tree hash, linear SHA-256 hex digest).
+        """
+        if self.chunk_fill or not self.stack:
+            self.add_chunk_hash(self.chunk.digest())
+        # Fold the remaining subtrees from the right.
+        part_hash = self.stack.pop()[1]
+        while self.stack:
+            part_hash = hashlib.sha256(self.stack.pop()[1] + part_hash).digest()
+        part = (self.part_fill, part_hash,
+                self.part_linear.hexdigest() if self.linear else None)
+        self.parts.append(part)
+        self.start_part()
+        return part
+
+    def add_part(self, size, part_tree_hash, sha256=None):
+        """
+        Account for a part that was hashed elsewhere. Must be called on
+        a part boundary.
+        """
+        assert self.part_fill == 0,\
+                "Parts can only be added on a part boundary."
+        self.parts.append((size, part_tree_hash, sha256))
+        self.size += size
+
+    def tree_hash(self):
+        """
+        Finish any pending data and return the tree hash of everything
+        written so far.
+        """
+        if self.part_fill or not self.parts:
+            self.finish_part()
+        return tree_hash(part[1] for part in self.parts)
+
+    def sha256(self):
+        """
+        The linear SHA-256 hex digest of the data. Only available when the
+        stream wasn't split into parts.
+        """
+        assert self.linear and not self.part_size and len(self.parts) <= 1,\
+                "Linear SHA-256 is only kept per part."
+        if self.part_fill or not self.parts:
+            self.finish_part()
+        return self.parts[0][2]
+
+def file_tree_hash(filename, workers=1):
+    """
+    Return the tree hash of a local file, hashed from a memory mapping
+    when the file can be mapped.
+    """
+    hasher = TreeHasher(workers=workers, linear=False)
+    with open(filename, 'rb') as reader:
+        try:
+            mapping = mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError, OverflowError):
+            mapping = None
+        if mapping:
+            hasher.update(buffer(mapping))
+            mapping.close()
+        else:
+            for block in iter((lambda:reader.read(32*1024*1024)), ''):
+                hasher.update(block)
+    return hasher.tree_hash()
+
+def bytes_to_hex(data):
+    return binascii.hexlify(data)
+
+class Journal(object):
+    """
+    Local journal of a transfer. The first line holds a JSON header
+    describing the transfer, every following line records a part
+    (offset, size and tree hash) that was transferred successfully, so
+    an interrupted transfer can be resumed without repeating them.
+    """
+    def __init__(self, path, header, parts=None):
+        self.path = path
+        self.header = header
+        self.parts = parts or {}
+        self.lock = threading.Lock()
+        self.journal = None
+
+    @classmethod
+    def create(cls, path, **header):
+        journal = cls(path, header)
+        with open(journal.path, 'w') as f:
+            f.write(json.dumps(header) + "\n")
+        return journal
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            header = json.loads(f.readline())
+            parts = {}
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Half-written line from an interrupted run.
+                    continue
+                parts[entry['offset']] = (entry['size'], entry['hash'])
+        return cls(path, header, parts)
+
+    def record_part(self, offset, size, part_tree_hash):
+        with self.lock:
+            self.parts[offset] = (size, part_tree_hash)
+            if self.journal is None:
+                self.journal = open(self.path, 'a')
+            self.journal.write(json.dumps({'offset': offset, 'size': size,
+                                           'hash': part_tree_hash}) + "\n")
+            self.journal.flush()
+
+    def remove(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class UploadJournal(Journal):
+    """
+    Journal of a multipart upload, kept in a directory of journals named
+    by upload ID.
+    """
+    @classmethod
+    def start(cls, directory, upload_id, **header):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        header['upload_id'] = upload_id
+        return cls.create(os.path.join(directory, upload_id), **header)
+
+    @classmethod
+    def find(cls, directory, **header):
+        """
+        Return the journal of an unfinished upload whose header matches
+        all the given values, or None.
+        """
+        if not os.path.isdir(directory):
+            return None
+        for name in sorted(os.listdir(directory)):
+            try:
+                journal = cls.load(os.path.join(directory, name))
+            except (IOError, ValueError):
+                continue
+            if all(journal.header.get(k) == v for k, v in header.items()):
+                return journal
+        return None
+
+    def verified_parts(self, stored_parts):
+        """
+        Return the journaled parts that Glacier also reports as stored
+        with the same size and tree hash.
+        """
+        return dict((offset, part) for offset, part in self.parts.items()
+                    if stored_parts.get(offset) == part)
 
 class GlacierWriter(object):
     """
     Presents a file-like object for writing to a Amazon Glacier
     Archive. The data is written using the multi-part upload API.
+
+    Parts are assembled in preallocated bytearrays of part_size, which
+    are sent as they are, so every byte is copied once on its way to the
+    socket. write_from fills the part buffer straight from a file with
+    readinto and avoids even that copy. write_mapped sends parts of a
+    memory-mapped file without any copy at all.
+
+    With concurrency > 1 the parts are handed over to a pool of upload
+    threads. Every thread checks out its own HTTP connection from the
+    connection's keep-alive pool. There are concurrency + 1 part
+    buffers: one being filled and at most `concurrency` in flight.
+
+    A part keeps its buffer until it is stored, so the connection's retry
+    policy re-sends it as it is if a request fails.
+
+    Data is fed to a TreeHasher as it is written, so the hashes of a
+    part are ready as soon as the part is complete. With hash_workers > 1
+    the 1MB chunks are hashed by a pool of that many threads.
+
+    Passing upload_id continues an existing multipart upload instead of
+    starting a new one; parts stored earlier are accounted for with
+    skip_part. If a journal is set, every stored part is recorded in it.
     """
     DEFAULT_PART_SIZE = 32*1024*1024 #32MB
-    def __init__(self, connection, vault, description=None, part_size=DEFAULT_PART_SIZE):
+    def __init__(self, connection, vault, description=None, part_size=DEFAULT_PART_SIZE,
+                 concurrency=1, upload_id=None, journal=None, hash_workers=1):
         self.part_size = part_size
+        self.buffer = None
         self.buffer_size = 0
         self.uploaded_size = 0
-        self.buffer = []
+        self.sent_size = 0
         self.vault = vault
         self.tree_hashes = []
+        self.hash_workers = hash_workers
+        self.hasher = TreeHasher(part_size, workers=hash_workers)
         self.archive_location = None
         self.closed = False
+        self.concurrency = max(1, concurrency)
 
-        self.connection = connection
+        self.journal = journal
 
-        headers = {
-                    "x-amz-glacier-version": "2012-06-01",
-                    "x-amz-part-size": str(self.part_size),
-                    "x-amz-archive-description": description
-                  }
-        response = self.connection.make_request(
-            "POST",
-            "/-/vaults/%s/multipart-uploads" % (urllib.quote(self.vault),),
-            headers,
-            "")
-        assert response.status == 201,\
-                "Multipart-start should respond with a 201! (got %s): %r"\
-                    % (response.status, response.read())
-        response.read()
-        self.upload_url = response.getheader("location")
+        self.connection = connection
+        self.connection.connection_pool.reserve(self.concurrency)
+        # Round trip time of the request starting the upload, and the
+        # (size, seconds) of every part sent, for UploadTuner.
+        self.request_latency = None
+        self.part_times = []
 
-    def send_part(self):
-        if sys.version_info < (2, 7, 0):
-            buf = "".join(self.buffer)
+        if upload_id is None:
+            headers = {
+                        "x-amz-glacier-version": "2012-06-01",
+                        "x-amz-part-size": str(self.part_size),
+                        "x-amz-archive-description": description
+                      }
+            start_time = time.time()
+            response = self.connection.make_request(
+                "POST",
+                "/-/vaults/%s/multipart-uploads" % (urllib.quote(self.vault),),
+                headers,
+                "")
+            self.request_latency = time.time() - start_time
+            check_response(response, (201,), "Multipart-start should respond with a 201!")
+            response.read()
+            self.upload_url = response.getheader("location")
+            self.upload_id = response.getheader("x-amz-multipart-upload-id")
         else:
-            # Usage of memoryview should speed up execution and be more mem friendly
-            buf = memoryview("".join(self.buffer))
+            self.upload_url = "/-/vaults/%s/multipart-uploads/%s" % (
+                                urllib.quote(self.vault), upload_id)
+            self.upload_id = upload_id
+        if not self.upload_id:
+            self.upload_id = self.upload_url.rsplit("/", 1)[-1]
 
-        # Put back any data remaining over the part size into the
-        # buffer
-        if len(buf) > self.part_size:
-            self.buffer = [buf[self.part_size:]]
-            self.buffer_size = len(self.buffer[0])
+        self.workers = []
+        self.errors = []
+        self.lock = threading.Lock()
+        self.free_buffers = Queue.Queue()
+        self.buffer_count = 0
+        if self.concurrency > 1:
+            self.in_flight = threading.Semaphore(self.concurrency)
+            self.queue = Queue.Queue()
+            for i in range(self.concurrency):
+                worker = threading.Thread(target=self.upload_worker)
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
 
-        else:
-            self.buffer = []
-            self.buffer_size = 0
+    def upload_worker(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                if not self.errors:
+                    self.upload_part(*item[1:])
+            except Exception:
+                self.errors.append(sys.exc_info())
+            finally:
+                if item is None:
+                    pass
+                elif item[0] is None:
+                    # A mapped part, which doesn't use a part buffer.
+                    self.in_flight.release()
+                else:
+                    self.free_buffers.put(item[0])
+                self.queue.task_done()
 
-        # The part we will send
-        part = buf[:self.part_size]
+    def add_worker(self):
+        """
+        Start one more upload thread, allowing one more part in flight.
+        Only for writers started with concurrency > 1.
+        """
+        assert self.workers, "Workers can only be added to a concurrent GlacierWriter."
+        worker = threading.Thread(target=self.upload_worker)
+        worker.daemon = True
+        worker.start()
+        self.workers.append(worker)
+        self.concurrency += 1
+        self.in_flight.release()
+        self.connection.connection_pool.reserve(self.concurrency)
+
+    def remove_worker(self):
+        """
+        Undo add_worker: allow one part fewer in flight, and stop one
+        upload thread once it has sent the parts queued before.
+        """
+        assert self.concurrency > 1, "The last upload thread can't be removed."
+        self.in_flight.acquire()
+        self.concurrency -= 1
+        # The stopped thread stays in self.workers; joining it is instant.
+        self.queue.put(None)
+
+    def check_errors(self):
+        """
+        Re-raise the first error any of the upload threads ran into,
+        after stopping the threads.
+        """
+        if self.errors:
+            self.stop_workers()
+            exc_type, exc_value, exc_tb = self.errors[0]
+            raise exc_type, exc_value, exc_tb
+
+    def stop_workers(self):
+        """
+        Wait until all queued parts are handled and stop the upload
+        threads.
+        """
+        if self.workers:
+            self.queue.join()
+            for worker in self.workers:
+                self.queue.put(None)
+            for worker in self.workers:
+                worker.join()
+            self.workers = []
+
+    def upload_part(self, offset, part, part_tree_hash, part_sha256, index=None):
+        if part_tree_hash is None:
+            # Mapped parts are hashed here, in the upload thread.
+            hasher = TreeHasher(workers=self.hash_workers)
+            hasher.update(part)
+            part_tree_hash = hasher.tree_hash()
+            part_sha256 = hasher.sha256()
+            self.tree_hashes[index] = part_tree_hash
+            self.hasher.parts[index] = (len(part), part_tree_hash, part_sha256)
 
         # Create a request and sign it
-        part_tree_hash = tree_hash(chunk_hashes(part))
-        self.tree_hashes.append(part_tree_hash)
         headers = {
                    "x-amz-glacier-version": "2012-06-01",
-                    "Content-Range": "bytes %d-%d/*" % (self.uploaded_size,
-                                                       (self.uploaded_size+len(part))-1),
+                    "Content-Range": "bytes %d-%d/*" % (offset,
+                                                       (offset+len(part))-1),
                     "Content-Length": str(len(part)),
                     "Content-Type": "application/octet-stream",
                     "x-amz-sha256-tree-hash": bytes_to_hex(part_tree_hash),
-                    "x-amz-content-sha256": hashlib.sha256(part).hexdigest()
+                    "x-amz-content-sha256": part_sha256
                   }
 
+        start_time = time.time()
         response = self.connection.make_request(
             "PUT",
             self.upload_url,
             headers,
             part)
 
-        assert response.status == 204,\
-                "Multipart upload part should respond with a 204! (got %s): %r"\
-                    % (response.status, response.read())
+        check_response(response, (204,), "Multipart upload part should respond with a 204!")
 
         response.read()
-        self.uploaded_size += len(part)
+        if self.journal is not None:
+            self.journal.record_part(offset, len(part), bytes_to_hex(part_tree_hash))
+        with self.lock:
+            self.uploaded_size += len(part)
+            self.part_times.append((len(part), time.time() - start_time))
+
+    def get_buffer(self):
+        """
+        Return the buffer the current part is assembled in. Up to
+        concurrency + 1 buffers are allocated; after that this waits for
+        an upload thread to hand one back.
+        """
+        if self.buffer is None:
+            if self.buffer_count <= len(self.workers):
+                self.buffer = bytearray(self.part_size)
+                self.buffer_count += 1
+            else:
+                self.buffer = self.free_buffers.get()
+        return self.buffer
+
+    def send_part(self):
+        # The part we will send. Its hashes were computed while it was
+        # written; only a trailing partial part still has to be finished.
+        part = memoryview(self.buffer)[:self.buffer_size]
+        if len(self.hasher.parts) == len(self.tree_hashes):
+            self.hasher.finish_part()
+        size, part_tree_hash, part_sha256 = self.hasher.parts[len(self.tree_hashes)]
+        self.tree_hashes.append(part_tree_hash)
+        offset = self.sent_size
+        self.sent_size += len(part)
+        self.buffer_size = 0
+
+        if self.concurrency > 1:
+            self.check_errors()
+            self.queue.put((self.buffer, offset, part, part_tree_hash, part_sha256))
+            self.buffer = None
+        else:
+            self.upload_part(offset, part, part_tree_hash, part_sha256)
+
+    def skip_part(self, size, part_tree_hash):
+        """
+        Account for a part of `size` bytes that is already stored in
+        Glacier (with the given hex tree hash) instead of sending it.
+        Must be called on a part boundary.
+        """
+        assert self.buffer_size == 0,\
+                "Parts can only be skipped on a part boundary."
+        part_tree_hash = binascii.unhexlify(part_tree_hash)
+        self.hasher.add_part(size, part_tree_hash)
+        self.tree_hashes.append(part_tree_hash)
+        self.sent_size += size
+        with self.lock:
+            self.uploaded_size += size
 
     def write(self, str):
         assert not self.closed, "Tried to write to a GlacierWriter that is already closed!"
-        self.buffer.append(str)
-        self.buffer_size += len(str)
-        while self.buffer_size > self.part_size:
-            self.send_part()
+        view = memoryview(str)
+        offset = 0
+        while offset < len(view):
+            buf = self.get_buffer()
+            take = min(self.part_size - self.buffer_size, len(view) - offset)
+            buf[self.buffer_size:self.buffer_size + take] = view[offset:offset + take]
+            self.hasher.update(view[offset:offset + take])
+            self.buffer_size += take
+            offset += take
+            if self.buffer_size == self.part_size:
+                self.send_part()
+
+    def write_mapped(self, mapping, offset, size):
+        """
+        Send `size` bytes at `offset` of a memory-mapped file as the next
+        part, straight from the mapping. The part is hashed by the thread
+        that uploads it, so with concurrency > 1 parts are hashed on
+        several cores. Must be called on a part boundary.
+        """
+        assert not self.closed, "Tried to write to a GlacierWriter that is already closed!"
+        assert self.buffer_size == 0 and offset == self.sent_size,\
+                "Mapped parts can only be sent on a part boundary."
+        part = buffer(mapping, offset, size)
+        index = len(self.tree_hashes)
+        self.tree_hashes.append(None)
+        self.hasher.add_part(size, None)
+        self.sent_size += size
+
+        if self.concurrency > 1:
+            self.check_errors()
+            self.in_flight.acquire()
+            self.queue.put((None, offset, part, None, None, index))
+        else:
+            self.upload_part(offset, part, None, None, index)
+
+    def write_from(self, reader, size):
+        """
+        Read up to `size` bytes from `reader` straight into the part
+        buffer. Returns the number of bytes read, 0 at end of file.
+        """
+        assert not self.closed, "Tried to write to a GlacierWriter that is already closed!"
+        buf = self.get_buffer()
+        end = min(self.part_size, self.buffer_size + size)
+        view = memoryview(buf)[self.buffer_size:end]
+        count = reader.readinto(view)
+        if count:
+            self.hasher.update(view[:count])
+            self.buffer_size += count
+            if self.buffer_size == self.part_size:
+                self.send_part()
+        return count
 
     def close(self):
         if self.closed:
             return
         if self.buffer_size > 0:
             self.send_part()
+        self.stop_workers()
+        self.check_errors()
+        if not self.tree_hashes:
+            # Glacier can't complete an upload without parts, and an upload
+            # left open lingers until it expires.
+            response = self.connection.make_request("DELETE", self.upload_url, {}, "")
+            check_response(response, (204,), "Multipart-abort should respond with a 204!")
+            response.read()
+            self.closed = True
+            raise Exception(u"Nothing was written, aborted multipart upload %s."
+                            % (self.upload_id,))
         # Complete the multiplart glacier upload
         headers = {
                     "x-amz-glacier-version": "2012-06-01",
                     "x-amz-sha256-tree-hash": bytes_to_hex(tree_hash(self.tree_hashes)),
-                    "x-amz-archive-size": str(self.uploaded_size)
+                    "x-amz-archive-size": str(self.sent_size)
                   }
-        response = self.connection.make_request(
-            "POST",
-            self.upload_url,
-            headers,
-            "")
+        # make_request doesn't retry the complete request, as Glacier may
+        # have completed the upload anyway. If it still has the upload it
+        # didn't, and another try is safe.
+        policy = self.connection.retry_policy
+        attempt = 0
+        while True:
+            try:
+                response = self.connection.make_request(
+                    "POST",
+                    self.upload_url,
+                    headers,
+                    "")
+                break
+            except (GlacierError,) + tuple(self.connection.http_exceptions), e:
+                if attempt >= policy.max_retries:
+                    raise
+                if not self.upload_exists():
+                    raise Exception(u"Completing multipart upload %s failed (%s), but "
+                                    "Glacier no longer has the upload, so it was most likely "
+                                    "completed anyway. The archive will be in the next "
+                                    "inventory of the vault." % (self.upload_id, e))
+                policy.backoff('server' if isinstance(e, GlacierError) else 'error', attempt)
+                attempt += 1
 
-        assert response.status == 201,\
-                "Multipart-complete should respond with a 201! (got %s): %r"\
-                    % (response.status, response.read())
+        check_response(response, (201,), "Multipart-complete should respond with a 201!")
         response.read()
         self.archive_id = response.getheader("x-amz-archive-id")
         self.location = response.getheader("Location")
         self.hash_sha256 = response.getheader("x-amz-sha256-tree-hash")
         self.closed = True
 
+    def upload_exists(self):
+        """
+        Whether Glacier still has the multipart upload. It forgets uploads
+        once they are completed or aborted.
+        """
+        response = self.connection.make_request("GET", self.upload_url, params={'limit': '1'})
+        if response.status == 404:
+            response.read()
+            return False
+        check_response(response, (200,), "List parts should respond with a 200!")
+        response.read()
+        return True
+
     def get_archive_id(self):
         self.close()
         return self.archive_id
@@ -376,3 +1610,109 @@ class GlacierWriter(object):
     def get_hash(self):
         self.close()
         return self.hash_sha256
+
+class UploadTuner(object):
+    """
+    Chooses the part size and concurrency of an upload from measured
+    throughput.
+
+    Glacier fixes the part size when a multipart upload starts, so it is
+    picked from the request latency and per-connection bandwidth measured
+    in earlier uploads (`stats`, see measured()): big enough that request
+    latency costs at most OVERHEAD of the time to send a part, but small
+    enough that a failed part can be re-sent within RESEND_TIME, and that
+    concurrency + 1 part buffers fit in max_memory.
+
+    Concurrency starts from what worked best last time. While the upload
+    runs, update() measures the throughput over windows of a few parts and
+    adds an upload thread as long as that keeps improving it by at least
+    IMPROVEMENT. The thread added last is removed again if it didn't.
+    """
+    OVERHEAD = 0.05
+    RESEND_TIME = 60
+    IMPROVEMENT = 1.1
+    DEFAULT_LATENCY = 0.2
+    DEFAULT_BANDWIDTH = 4*1024*1024
+    MIN_PART_SIZE = 1024*1024
+    MAX_PART_SIZE = 4*1024*1024*1024
+    MAX_PARTS = 10000
+
+    def __init__(self, stats=None, max_memory=512*1024*1024, max_concurrency=16):
+        stats = stats or {}
+        self.latency = stats.get('latency') or self.DEFAULT_LATENCY
+        self.bandwidth = stats.get('bandwidth') or self.DEFAULT_BANDWIDTH
+        self.concurrency = max(2, min(max_concurrency, stats.get('concurrency') or 2))
+        self.max_memory = max_memory
+        self.max_concurrency = max_concurrency
+        self.part = self.MIN_PART_SIZE
+        self.best_rate = None
+        self.best_concurrency = self.concurrency
+        self.peak_concurrency = self.concurrency
+        self.settled = False
+        self.window_start = None
+        self.window_size = 0
+
+    def part_size(self, total_size=0):
+        """
+        Part size in bytes for an archive of total_size bytes (0 if not
+        known). Also lowers concurrency if the buffers wouldn't fit in
+        max_memory.
+        """
+        power_of_2 = lambda v: 1 << int(math.ceil(math.log(max(v, 1), 2)))
+        # Big enough for latency to be at most OVERHEAD of a part's time.
+        part = power_of_2(self.latency * self.bandwidth * (1 - self.OVERHEAD) / self.OVERHEAD)
+        # Small enough to re-send in RESEND_TIME, and to buffer in max_memory.
+        while part > self.MIN_PART_SIZE and (part > self.RESEND_TIME * self.bandwidth or
+                                             part * 3 > self.max_memory):
+            part /= 2
+        # But never more than 10,000 parts.
+        part = max(part, self.MIN_PART_SIZE,
+                   power_of_2(int(math.ceil(total_size / float(self.MAX_PARTS)))))
+        self.part = min(part, self.MAX_PART_SIZE)
+        self.concurrency = max(2, min(self.concurrency, self.max_memory / self.part - 1))
+        self.best_concurrency = self.peak_concurrency = self.concurrency
+        return self.part
+
+    def update(self, writer):
+        """
+        Call after every part written: compares the throughput of the
+        last few parts with the best so far and adds an upload thread
+        while that helps.
+        """
+        if self.settled:
+            return
+        now = time.time()
+        if self.window_start is None:
+            self.window_start, self.window_size = now, writer.uploaded_size
+            return
+        done = writer.uploaded_size - self.window_size
+        if done < 2 * writer.concurrency * writer.part_size or now <= self.window_start:
+            return
+        rate = done / (now - self.window_start)
+        if self.best_rate is None or rate > self.best_rate * self.IMPROVEMENT:
+            self.best_rate = rate
+            self.best_concurrency = writer.concurrency
+            if (writer.concurrency < self.max_concurrency and
+                    (writer.concurrency + 2) * writer.part_size <= self.max_memory):
+                writer.add_worker()
+                self.peak_concurrency = max(self.peak_concurrency, writer.concurrency)
+            else:
+                self.settled = True
+        else:
+            # The thread added to probe didn't pay off.
+            while writer.concurrency > self.best_concurrency:
+                writer.remove_worker()
+            self.settled = True
+        self.window_start, self.window_size = now, writer.uploaded_size
+
+    def measured(self, writer):
+        """
+        Latency, per-connection bandwidth and best concurrency seen in the
+        upload, to pass as stats to the tuner of the next one.
+        """
+        latency = writer.request_latency or self.latency
+        rates = sorted(size / max(seconds - latency, 0.001)
+                       for size, seconds in writer.part_times)
+        return {'latency': latency,
+                'bandwidth': rates[len(rates) / 2] if rates else self.bandwidth,
+                'concurrency': self.best_concurrency}